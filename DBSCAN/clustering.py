@@ -2,154 +2,441 @@
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import math
-import sys
+import multiprocessing
+import time
 
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
 
-class Point(object):
-    def __init__(self, id, x, y, visited=False):
-        self.id = int(id)
-        self.x = float(x)
-        self.y = float(y)
-        self.visited = visited
+# Labels of points which are not cluster ids
+UNASSIGNED = -2
+NOISE = -1
+
+
+class UnionFind(object):
+    """Disjoint sets of 0..size-1"""
+
+    def __init__(self, size):
+        self._parent = list(range(size))
+
+    def find(self, x):
+        parent = self._parent
+        while parent[x] != x:
+            # Path halving
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x != y:
+            self._parent[max(x, y)] = min(x, y)
 
 
 class DBSCANClusterBuilder(object):
-    def __init__(self, input_filename, cluster_count, eps, min_pts):
+    def __init__(self, input_filename, cluster_count, eps, min_pts, workers=1):
         self._input_filename = input_filename
         self._cluster_count = int(cluster_count)
-        self._eps = int(eps)
+        self._eps = float(eps)
         self._min_pts = int(min_pts)
-        self.data = set()
-        self.noises = set()
+        # Number of processes to cluster tiles of the plane with, 1 runs the sequential algorithm
+        self._workers = workers
+        # Points are indexed by their position in the input file
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self._visited = np.zeros(0, dtype=bool)
+        # Every point before the cursor is visited
+        self._cursor = 0
+        # Point indices of noises and of each cluster
+        self.noises = []
         self.clusters = []
+        # Grid cell of each point, a cell is an eps x eps square
+        self._cell_columns = np.zeros(0, dtype=np.int64)
+        self._cell_rows = np.zeros(0, dtype=np.int64)
+        # (column, row) -> point indices in the cell
+        self._grid = {}
+        # (column, row) -> point indices in the cell and the 8 cells around it
+        self._blocks = {}
+        # Cluster id (index of self.clusters before sorting), NOISE or UNASSIGNED by point index
+        self._labels = np.zeros(0, dtype=np.int64)
+        # Whether each point has min_pts points within eps, parallel clustering only
+        self._core = np.zeros(0, dtype=bool)
+        # Pairs of points within the largest eps of a sweep with their squared distances,
+        # and squared distances to neighbors of each point in ascending order from _neighbor_starts
+        self._neighbor_pairs = np.zeros((0, 2), dtype=np.int64)
+        self._neighbor_distances = np.zeros(0)
+        self._sorted_neighbor_distances = np.zeros(0)
+        self._neighbor_starts = np.zeros(0, dtype=np.int64)
+        self._neighbor_counts = np.zeros(0, dtype=np.int64)
 
     def _load_points_from_input_file(self):
         """Load points from given input file"""
-        with open(self._input_filename, 'r') as f:
-            for idx, line in enumerate(f):
-                # data format [object_id]\t[x_coordinate]\t[y_coordinate]
-                data = line.strip().split('\t')
-                p = Point(data[0], data[1], data[2])
-                self.data.add(p)
-
-    def _get_points_of_neighborhood_radius(self, given_p):
-        """Return neighborhood points inside of given radius(eps) for given p"""
-        pts = []
-        for p in self.data:
-            if ((p.x - given_p.x) ** 2 + (p.y - given_p.y) ** 2) <= self._eps ** 2:
-                pts.append(p)
-
-        return pts
+        # data format [object_id]\t[x_coordinate]\t[y_coordinate]
+        points = np.loadtxt(
+            self._input_filename, delimiter='\t', usecols=(0, 1, 2),
+            dtype=[('id', np.int64), ('x', np.float64), ('y', np.float64)], ndmin=1
+        )
+        self.ids = np.ascontiguousarray(points['id'])
+        self.x = np.ascontiguousarray(points['x'])
+        self.y = np.ascontiguousarray(points['y'])
+
+        self._visited = np.zeros(len(self.ids), dtype=bool)
+        self._cursor = 0
+        self._labels = np.full(len(self.ids), UNASSIGNED, dtype=np.int64)
+
+    def _build_grid(self):
+        """Index points by grid cells so that a neighborhood query only looks into the nearby cells"""
+        # Any positive cell size works for eps 0 which matches points on the same coordinate only
+        cell_size = self._eps if self._eps > 0 else 1
+        self._cell_columns = np.floor(self.x / cell_size).astype(np.int64)
+        self._cell_rows = np.floor(self.y / cell_size).astype(np.int64)
+
+        self._grid = {}
+        self._blocks = {}
+        order = np.lexsort((self._cell_rows, self._cell_columns))
+        if not len(order):
+            # No points, no cells
+            return
+
+        columns = self._cell_columns[order]
+        rows = self._cell_rows[order]
+        # Start of each run of points in the same cell
+        starts = np.flatnonzero(np.r_[True, (columns[1:] != columns[:-1]) | (rows[1:] != rows[:-1])])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            self._grid[(int(columns[start]), int(rows[start]))] = order[start:end]
+
+    def _get_block(self, column, row):
+        """Return point indices in the cell and the 8 cells around it, points within eps are all in there"""
+        block = self._blocks.get((column, row))
+        if block is None:
+            cells = [self._grid.get((column + dx, row + dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+            block = np.concatenate([x for x in cells if x is not None])
+            self._blocks[(column, row)] = block
+
+        return block
+
+    def _get_points_of_neighborhood_radius(self, idx):
+        """Return indices of neighborhood points inside of given radius(eps) for given point index"""
+        block = self._get_block(int(self._cell_columns[idx]), int(self._cell_rows[idx]))
+        dist = (self.x[block] - self.x[idx]) ** 2 + (self.y[block] - self.y[idx]) ** 2
+        return block[dist <= self._eps ** 2]
+
+    def _add_seeds(self, pts, cluster_id, seeds):
+        """Label points which are not in any cluster yet with cluster_id and queue them to expand"""
+        # Unvisited points are unassigned, and queued ones are labeled already so they're not queued twice
+        pts = pts[self._labels[pts] == UNASSIGNED]
+        self._labels[pts] = cluster_id
+        seeds.extend(pts.tolist())
 
     def _find_unvisited_point(self):
-        """Return unvisited point from all points"""
-        for p in self.data:
-            if not p.visited:
-                return p
+        """Return index of an unvisited point, None if all points are visited"""
+        while self._cursor < len(self._visited) and self._visited[self._cursor]:
+            self._cursor += 1
 
-        return None
+        if self._cursor == len(self._visited):
+            return None
+        return self._cursor
 
     def _get_avg_points_of_clusters(self):
-        """Return all average x-coordinate, y-coordinate point of each cluster"""
-        cluster_avg_points = []
-        for cluster in self.clusters:
-            total_x = 0
-            total_y = 0
-            for p in cluster:
-                total_x += p.x
-                total_y += p.y
-
-            p = Point(0, total_x / len(cluster), total_y / len(cluster))
-            cluster_avg_points.append(p)
-
-        return cluster_avg_points
+        """Return average x-coordinates and y-coordinates of each cluster"""
+        avg_x = np.array([self.x[cluster].mean() for cluster in self.clusters])
+        avg_y = np.array([self.y[cluster].mean() for cluster in self.clusters])
+        return avg_x, avg_y
 
     def _sort_clusters_by_count(self):
         self.clusters.sort(key=lambda x: len(x), reverse=True)
 
-    def _adjust(self):
+    def _adjust(self, chunk_size=1 << 20):
         """Adjust outlier points into nearby cluster"""
-        cluster_avg_points = self._get_avg_points_of_clusters()
+        if not self.clusters or not self.noises:
+            return 0
 
-        # Calculate average dist to average point of cluster
-        avg_dist_list = [0] * len(self.clusters)
-        for idx, cluster in enumerate(self.clusters):
-            for p in cluster:
-                avg_point = cluster_avg_points[idx]
-                dist = math.sqrt((avg_point.x - p.x) ** 2 + (avg_point.y - p.y) ** 2)
-                avg_dist_list[idx] += dist
-
-            avg_dist_list[idx] /= len(cluster)
-
-        # Adjust noises to be included in some cluster
-        adjusted_count = 0
-        for p in self.noises:
-            min_dist = sys.maxsize
-            cluster_idx = None
-            for idx, avg_point in enumerate(cluster_avg_points):
-                dist = math.sqrt((avg_point.x - p.x) ** 2 + (avg_point.y - p.y) ** 2)
-                if dist < min_dist and dist <= avg_dist_list[idx] ** 2:
-                    min_dist = dist
-                    cluster_idx = idx
-
-            if cluster_idx:
-                self.clusters[cluster_idx].add(p)
-                adjusted_count += 1
-
-        return adjusted_count
+        avg_x, avg_y = self._get_avg_points_of_clusters()
 
-    def run(self):
-        # Load points from input file
+        # Calculate average dist to average point of cluster
+        avg_dist = np.array([
+            np.sqrt((avg_x[idx] - self.x[cluster]) ** 2 + (avg_y[idx] - self.y[cluster]) ** 2).mean()
+            for idx, cluster in enumerate(self.clusters)
+        ])
+
+        # Adjust noises to be included in some cluster, a chunk of noises x clusters distances at a time
+        noises = np.array(self.noises, dtype=np.int64)
+        nearest = np.empty(len(noises), dtype=np.int64)
+        rows = max(1, chunk_size // len(self.clusters))
+        for start in range(0, len(noises), rows):
+            chunk = noises[start:start + rows]
+            dist = np.sqrt(
+                (avg_x[np.newaxis, :] - self.x[chunk, np.newaxis]) ** 2 +
+                (avg_y[np.newaxis, :] - self.y[chunk, np.newaxis]) ** 2
+            )
+            # A cluster is a candidate if the distance is within its average distance "squared"
+            dist[dist > avg_dist ** 2] = np.inf
+            nearest[start:start + rows] = np.where(np.isinf(dist).all(axis=1), -1, dist.argmin(axis=1))
+
+        # Noises nearest to the first cluster have never been adjusted
+        adjusted = nearest > 0
+        adjusted_noises = noises[adjusted]
+        adjusted_clusters = nearest[adjusted]
+        for idx in np.unique(adjusted_clusters):
+            self.clusters[idx] = np.concatenate([self.clusters[idx], adjusted_noises[adjusted_clusters == idx]])
+
+        return len(adjusted_noises)
+
+    def _get_tiles(self, tile_count):
+        """Return (min x, max x, min y, max y) of tiles which split the points evenly by both coordinates"""
+        tile_columns = int(math.ceil(math.sqrt(tile_count)))
+        tile_rows = int(math.ceil(tile_count / tile_columns))
+
+        x_bounds = np.quantile(self.x, np.linspace(0, 1, tile_columns + 1))
+        y_bounds = np.quantile(self.y, np.linspace(0, 1, tile_rows + 1))
+        x_bounds[0] = y_bounds[0] = -np.inf
+        x_bounds[-1] = y_bounds[-1] = np.inf
+
+        return [(x_bounds[i], x_bounds[i + 1], y_bounds[j], y_bounds[j + 1])
+                for i in range(tile_columns) for j in range(tile_rows)]
+
+    def _cluster_in_parallel(self):
+        """Cluster with the same result as the sequential algorithm by clustering tiles in a process pool
+
+        Cores and cluster of cores don't depend on the order points are visited. A non-core point
+        goes to the earliest found cluster with a core within eps, unless it was visited as a noise
+        before the cluster is found. A cluster is found when its first core point in the input is visited.
+        """
+        point_count = len(self.ids)
+        if not point_count:
+            # Nothing to cluster, and no quantiles to tile an empty plane by
+            return
+
+        tiles = self._get_tiles(self._workers * 4)
+
+        # Cores, a tile knows all neighbors of its own points by the eps wide halo around it
+        core = np.zeros(point_count, dtype=bool)
+        with _create_worker_pool(self, self._workers) as pool:
+            for owned, neighbor_counts in pool.imap(_count_tile_neighbors, tiles):
+                core[owned] = neighbor_counts >= self._min_pts
+        self._core = core
+
+        # Clusters of cores in each tile (and its halo), and clusters of cores near to non-core points
+        core_tile_labels = []
+        border_tile_labels = []
+        label_count = 0
+        with _create_worker_pool(self, self._workers) as pool:
+            for cores, core_labels, borders, border_labels, count in pool.imap(_label_tile, tiles):
+                core_tile_labels.append((cores, core_labels + label_count))
+                border_tile_labels.append((borders, border_labels + label_count))
+                label_count += count
+
+        # Merge tile clusters sharing a core point
+        cores = np.concatenate([x[0] for x in core_tile_labels] + [np.zeros(0, dtype=np.int64)])
+        core_labels = np.concatenate([x[1] for x in core_tile_labels] + [np.zeros(0, dtype=np.int64)])
+        order = np.argsort(cores, kind='stable')
+        cores = cores[order]
+        core_labels = core_labels[order]
+        union_find = UnionFind(label_count)
+        for idx in np.flatnonzero(cores[1:] == cores[:-1]).tolist():
+            union_find.union(int(core_labels[idx]), int(core_labels[idx + 1]))
+        roots = np.array([union_find.find(x) for x in range(label_count)], dtype=np.int64)
+
+        # Cluster of a core is found when its first core point is visited
+        found_at = np.full(label_count, point_count, dtype=np.int64)
+        np.minimum.at(found_at, roots[core_labels], cores)
+        point_found_at = np.full(point_count, point_count, dtype=np.int64)
+        point_found_at[cores] = found_at[roots[core_labels]]
+
+        # Earliest found cluster near to each non-core point, which gets it unless the point is visited before
+        borders = np.concatenate([x[0] for x in border_tile_labels] + [np.zeros(0, dtype=np.int64)])
+        border_labels = np.concatenate([x[1] for x in border_tile_labels] + [np.zeros(0, dtype=np.int64)])
+        border_found_at = np.full(point_count, point_count, dtype=np.int64)
+        np.minimum.at(border_found_at, borders, found_at[roots[border_labels]])
+        claimed = ~core & (border_found_at < np.arange(point_count))
+        point_found_at[claimed] = border_found_at[claimed]
+
+        # Clusters by order they are found, and points of a cluster by the input order
+        clustered = np.flatnonzero(point_found_at < point_count)
+        clustered = clustered[np.argsort(point_found_at[clustered], kind='stable')]
+        starts = np.flatnonzero(np.r_[True, np.diff(point_found_at[clustered]) != 0]) if len(clustered) else []
+        self.clusters = np.split(clustered, starts[1:])
+        for cluster_id, cluster in enumerate(self.clusters):
+            self._labels[cluster] = cluster_id
+
+        noises = np.flatnonzero(point_found_at == point_count)
+        self._labels[noises] = NOISE
+        self.noises = noises.tolist()
+        self._visited[:] = True
+
+    def _get_tile_neighbors(self, tile):
+        """Return point indices of given tile and its eps wide halo, whether they're in the tile
+        and pairs of positions (in the indices) of points within eps
+        """
+        min_x, max_x, min_y, max_y = tile
+        x = self.x
+        y = self.y
+        indices = np.flatnonzero(
+            (x >= min_x - self._eps) & (x <= max_x + self._eps) & (y >= min_y - self._eps) & (y <= max_y + self._eps)
+        )
+        tile_x = x[indices]
+        tile_y = y[indices]
+        owned = (tile_x >= min_x) & (tile_x < max_x) & (tile_y >= min_y) & (tile_y < max_y)
+
+        pairs, _ = _get_neighbor_pairs(tile_x, tile_y, self._eps)
+        return indices, owned, pairs
+
+    def _build_neighbor_graph(self, max_eps):
+        """Find all pairs of points within max_eps and sort the neighbor distances of each point"""
+        self._neighbor_pairs, self._neighbor_distances = _get_neighbor_pairs(self.x, self.y, max_eps)
+
+        points = self._neighbor_pairs.T.ravel()
+        distances = np.concatenate([self._neighbor_distances, self._neighbor_distances])
+        order = np.lexsort((distances, points))
+        self._sorted_neighbor_distances = distances[order]
+        self._neighbor_counts = np.bincount(points, minlength=len(self.ids))
+        self._neighbor_starts = np.cumsum(self._neighbor_counts) - self._neighbor_counts
+
+    def _get_core_distances(self, min_pts):
+        """Return the smallest squared eps making each point a core, inf if it's larger than the graph's eps"""
+        # Distance to the (min_pts - 1)-th nearest neighbor, the point itself counts as one
+        k = min_pts - 1
+        if k <= 0:
+            return np.zeros(len(self.ids))
+
+        core_distances = np.full(len(self.ids), np.inf)
+        enough = self._neighbor_counts >= k
+        core_distances[enough] = self._sorted_neighbor_distances[self._neighbor_starts[enough] + k - 1]
+        return core_distances
+
+    def sweep(self, eps_values, min_pts_values):
+        """Yield (eps, min_pts, cluster count, core count, noise count, seconds) of each setting
+
+        Neighbors within the largest eps are found once. For a min_pts, a pair of points joins two
+        clusters from the eps reaching both core distances and the distance between them, so clusters
+        of a larger eps come from a longer prefix of the pairs ordered by that eps (like OPTICS).
+        Noises are counted like the sequential run (see _cluster_in_parallel).
+        """
         self._load_points_from_input_file()
+        point_count = len(self.ids)
+
+        start = time.perf_counter()
+        self._build_neighbor_graph(max(eps_values))
+        print('Neighbor graph: {} pairs in {:.3f}s'.format(len(self._neighbor_pairs), time.perf_counter() - start))
+
+        first, second = self._neighbor_pairs[:, 0], self._neighbor_pairs[:, 1]
+        # Pairs in both directions by distance, pairs within an eps are a prefix of them
+        order = np.argsort(np.concatenate([self._neighbor_distances, self._neighbor_distances]), kind='stable')
+        near_distances = np.concatenate([self._neighbor_distances, self._neighbor_distances])[order]
+        near_points = np.concatenate([first, second])[order]
+        near_neighbors = np.concatenate([second, first])[order]
+        positions = np.arange(point_count)
+
+        for min_pts in min_pts_values:
+            start = time.perf_counter()
+            core_distances = self._get_core_distances(min_pts)
+            sorted_core_distances = np.sort(core_distances)
+
+            # Smallest squared eps connecting each pair as cores
+            reach = np.maximum(self._neighbor_distances, np.maximum(core_distances[first], core_distances[second]))
+            order = np.argsort(reach, kind='stable')
+            sorted_reach = reach[order]
+            sorted_pairs = self._neighbor_pairs[order]
+
+            elapsed = time.perf_counter() - start
+
+            for eps in eps_values:
+                start = time.perf_counter()
+                max_distance = eps ** 2
+                core_count = int(np.searchsorted(sorted_core_distances, max_distance, side='right'))
+                pairs = sorted_pairs[:np.searchsorted(sorted_reach, max_distance, side='right')]
+                graph = sparse.csr_matrix(
+                    (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                    shape=(point_count, point_count)
+                )
+                # Non-core points have no pairs and are components by themselves
+                component_count, labels = csgraph.connected_components(graph, directed=False)
+                cluster_count = component_count - (point_count - core_count)
+
+                # Input position where each cluster is found, and the earliest one near to each non-core point
+                core = core_distances <= max_distance
+                found_at = np.full(component_count, point_count, dtype=np.int64)
+                np.minimum.at(found_at, labels[core], positions[core])
+                near_count = np.searchsorted(near_distances, max_distance, side='right')
+                near = near_points[:near_count]
+                neighbors = near_neighbors[:near_count]
+                near_core = ~core[near] & core[neighbors]
+                border_found_at = np.full(point_count, point_count, dtype=np.int64)
+                np.minimum.at(border_found_at, near[near_core], found_at[labels[neighbors[near_core]]])
+                noise_count = int(np.count_nonzero(~core & (border_found_at >= positions)))
+
+                # The per min_pts preparation is shared by its settings
+                yield eps, min_pts, cluster_count, core_count, noise_count, elapsed + time.perf_counter() - start
+                elapsed = 0
+
+    def run_sweep(self, eps_values, min_pts_values):
+        settings = self.sweep(sorted(set(eps_values)), sorted(set(min_pts_values)))
+        for idx, (eps, min_pts, cluster_count, core_count, noise_count, elapsed) in enumerate(settings):
+            if idx == 0:
+                print('eps\tmin_pts\tclusters\tcores\tnoises\ttime(ms)')
+            print('{:g}\t{}\t{}\t{}\t{}\t{:.1f}{}'.format(
+                eps, min_pts, cluster_count, core_count, noise_count, elapsed * 1000,
+                # Settings giving the wanted cluster count
+                '\t*' if cluster_count == self._cluster_count else ''
+            ))
+
+    def _cluster(self):
+        """Visit points by the input order and expand a cluster from each unvisited core point"""
+        self._build_grid()
 
-        print("Running...")
         while True:
             # Run until there's no unvisited point
             p = self._find_unvisited_point()
-            if not p:
+            if p is None:
                 break
 
             # Mark current point as visited
-            p.visited = True
+            self._visited[p] = True
 
             neighborhood_pts = self._get_points_of_neighborhood_radius(p)
             if len(neighborhood_pts) >= self._min_pts:
                 # Trying to generate a new cluster
-                new_cluster = set()
-                new_cluster.add(p)
-
-                for neighborhood_p in neighborhood_pts:
-                    if not neighborhood_p.visited:
-                        # Mark neighborhood point as visited
-                        neighborhood_p.visited = True
-
-                        # Find all neighborhood points of given neighborhood point
-                        neighbor_pts_of_given_p = self._get_points_of_neighborhood_radius(
-                            neighborhood_p
-                        )
-
-                        if len(neighbor_pts_of_given_p) >= self._min_pts:
-                            # Continuously extend points with neighbor points
-                            neighborhood_pts.extend(neighbor_pts_of_given_p)
-
-                        # Add a point to cluster if is not a member of another cluster
-                        is_member_of_another_cluster = False
-                        for cluster in self.clusters:
-                            for cluster_p in cluster:
-                                if cluster_p.id == neighborhood_p.id:
-                                    is_member_of_another_cluster = True
-                                    break
-                        if not is_member_of_another_cluster:
-                            new_cluster.add(neighborhood_p)
+                cluster_id = len(self.clusters)
+                self._labels[p] = cluster_id
+
+                # Each point is queued once, by the first core point which reaches it
+                seeds = []
+                self._add_seeds(neighborhood_pts, cluster_id, seeds)
+                for neighborhood_p in seeds:
+                    # Mark neighborhood point as visited
+                    self._visited[neighborhood_p] = True
+
+                    # Find all neighborhood points of given neighborhood point
+                    neighbor_pts_of_given_p = self._get_points_of_neighborhood_radius(neighborhood_p)
+                    if len(neighbor_pts_of_given_p) >= self._min_pts:
+                        # Continuously extend points with neighbor points
+                        self._add_seeds(neighbor_pts_of_given_p, cluster_id, seeds)
 
                 # Adding a new cluster into cluster list
-                self.clusters.append(new_cluster)
+                self.clusters.append(np.array([p] + seeds, dtype=np.int64))
             else:
-                self.noises.add(p)
+                self._labels[p] = NOISE
+                self.noises.append(p)
                 # P is noise
                 continue
 
+    def run(self):
+        # Load points from input file
+        self._load_points_from_input_file()
+
+        print("Running...")
+        if self._workers > 1:
+            self._cluster_in_parallel()
+        else:
+            self._cluster()
+
         # Adjusting outlier points into cluster
         adjusted_count = self._adjust()
 
@@ -172,13 +459,106 @@ class DBSCANClusterBuilder(object):
                 break
             # Write result clusters into file
             with open(filename_frags[0] + '_cluster_' + str(idx) + '.txt', 'w') as f:
-                for p in cluster:
-                    f.write('{}\n'.format(p.id))
+                f.write(''.join('{}\n'.format(x) for x in self.ids[cluster].tolist()))
+
+
+def _get_neighbor_pairs(x, y, eps):
+    """Return pairs of point positions within eps and their squared distances"""
+    # Look a bit farther than eps and check the distance exactly like a neighborhood query
+    tree = cKDTree(np.column_stack((x, y)))
+    pairs = tree.query_pairs(eps * (1 + 1e-9), output_type='ndarray').reshape(-1, 2).astype(np.int64)
+    distances = (x[pairs[:, 0]] - x[pairs[:, 1]]) ** 2 + (y[pairs[:, 0]] - y[pairs[:, 1]]) ** 2
+    within = distances <= eps ** 2
+    return pairs[within], distances[within]
+
+
+def _parse_values(text, cast):
+    """Return values of a number or an inclusive range written as start:stop:step"""
+    if ':' not in text:
+        return [cast(text)]
+
+    start, stop, step = (float(x) for x in text.split(':'))
+    count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    return [cast(start + step * x) for x in range(count)]
+
+
+# Builder of tile worker processes, forked workers inherit it with the points from the parent
+_worker_builder = None
+
+
+def _init_worker(builder):
+    global _worker_builder
+    _worker_builder = builder
+
+
+def _create_worker_pool(builder, workers):
+    global _worker_builder
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _worker_builder = builder
+        return multiprocessing.get_context('fork').Pool(workers)
+
+    # No fork (e.g. Windows), send the builder once per worker instead
+    return multiprocessing.Pool(workers, initializer=_init_worker, initargs=(builder,))
+
+
+def _count_tile_neighbors(tile):
+    """Return indices of points in the tile and their neighbor counts, including themselves"""
+    indices, owned, pairs = _worker_builder._get_tile_neighbors(tile)
+    neighbor_counts = 1 + np.bincount(pairs.ravel(), minlength=len(indices))
+    return indices[owned], neighbor_counts[owned]
+
+
+def _label_tile(tile):
+    """Return cores of the tile and its halo with their cluster labels in the tile,
+    pairs of non-core points of the tile and labels of clusters having a core within eps, and the label count
+    """
+    indices, owned, pairs = _worker_builder._get_tile_neighbors(tile)
+    core = _worker_builder._core[indices]
+
+    # Connected cores are in the same cluster
+    core_positions = np.flatnonzero(core)
+    core_numbers = np.cumsum(core) - 1
+    core_pairs = core_numbers[pairs[core[pairs[:, 0]] & core[pairs[:, 1]]]]
+    graph = sparse.csr_matrix(
+        (np.ones(len(core_pairs), dtype=np.int8), (core_pairs[:, 0], core_pairs[:, 1])),
+        shape=(len(core_positions), len(core_positions))
+    )
+    label_count, labels = csgraph.connected_components(graph, directed=False)
+    position_labels = np.full(len(indices), -1, dtype=np.int64)
+    position_labels[core_positions] = labels
+
+    # Both directions of (non-core point of the tile, core), and distinct (point, label) of them
+    border_pairs = np.concatenate([pairs, pairs[:, ::-1]])
+    border_pairs = border_pairs[owned[border_pairs[:, 0]] & ~core[border_pairs[:, 0]] & core[border_pairs[:, 1]]]
+    keys = np.unique(border_pairs[:, 0] * max(1, label_count) + position_labels[border_pairs[:, 1]])
+    borders, border_labels = np.divmod(keys, max(1, label_count))
+
+    return indices[core_positions], labels.astype(np.int64), indices[borders], border_labels, label_count
 
 
 if __name__ == '__main__':
-    # eps: Maximum radius of the neighborhood
-    # min_pts: Minimum number of points in an eps-neighborhood of a given point
-    _, input_filename, cluster_count, eps, min_pts = sys.argv
-    builder = DBSCANClusterBuilder(input_filename, cluster_count, eps, min_pts)
-    builder.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_filename')
+    parser.add_argument('cluster_count')
+    # Maximum radius of the neighborhood
+    parser.add_argument('eps')
+    # Minimum number of points in an eps-neighborhood of a given point
+    parser.add_argument('min_pts')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of processes to cluster tiles of the plane with (default: 1, sequential)')
+    parser.add_argument('--sweep-eps', nargs='+', default=None, metavar='EPS',
+                        help='report cluster counts of these eps values (or start:stop:step ranges) '
+                             'instead of clustering')
+    parser.add_argument('--sweep-min-pts', nargs='+', default=None, metavar='MIN_PTS',
+                        help='report cluster counts of these min_pts values (or start:stop:step ranges) '
+                             'instead of clustering')
+    args = parser.parse_args()
+
+    builder = DBSCANClusterBuilder(args.input_filename, args.cluster_count, args.eps, args.min_pts, args.workers)
+    if args.sweep_eps is None and args.sweep_min_pts is None:
+        builder.run()
+    else:
+        builder.run_sweep(
+            [x for value in args.sweep_eps or [args.eps] for x in _parse_values(value, float)],
+            [x for value in args.sweep_min_pts or [args.min_pts] for x in _parse_values(value, int)]
+        )
@@ -2,18 +2,115 @@
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import itertools
-import sys
-from decimal import Decimal, ROUND_HALF_UP
+import multiprocessing
+import os
+from array import array
+from fractions import Fraction
+
+
+class CandidateTrie(object):
+    """Prefix trie of same length candidates to enumerate candidates contained in a transaction"""
+
+    def __init__(self, candidates, itemset_length):
+        self._itemset_length = itemset_length
+        self._root = {}
+        for idx, candidate in enumerate(candidates):
+            node = self._root
+            items = sorted(candidate)
+            for item in items[:-1]:
+                node = node.setdefault(item, {})
+            # Leaf holds index of the candidate
+            node[items[-1]] = idx
+
+    def find(self, transaction):
+        """Return indices of candidates which are subsets of given sorted transaction items"""
+        found = []
+        self._find(self._root, transaction, 0, 1, found)
+        return found
+
+    def _find(self, node, transaction, start, depth, found):
+        # Leave enough items in the transaction for the rest of the candidate
+        end = len(transaction) - (self._itemset_length - depth)
+        for idx in range(start, end):
+            child = node.get(transaction[idx])
+            if child is None:
+                continue
+
+            if depth == self._itemset_length:
+                found.append(child)
+            else:
+                self._find(child, transaction, idx + 1, depth + 1, found)
+
+
+def _read_byte_range(filename, start, end):
+    """Yield lines of a file which start in [start, end) bytes"""
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # The line going over start belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode()
+
+
+def _count_transactions(trie, lines, candidate_count, itemset_length):
+    """Return support counts of candidates and line index of their first appearance (-1 if none)"""
+    counts = array('q', [0]) * candidate_count
+    first_lines = array('q', [-1]) * candidate_count
+
+    for line_idx, line in enumerate(lines):
+        numbers = sorted(set(map(int, line.strip().split('\t'))))
+        if len(numbers) < itemset_length:
+            continue
+
+        for idx in trie.find(numbers):
+            if counts[idx] == 0:
+                first_lines[idx] = line_idx
+            counts[idx] += 1
+
+    return counts, first_lines
+
+
+# Trie of counting worker processes, forked workers inherit it from the parent
+_worker_trie = None
+
+
+def _init_worker(trie):
+    global _worker_trie
+    _worker_trie = trie
+
+
+def _create_worker_pool(trie, workers):
+    global _worker_trie
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _worker_trie = trie
+        return multiprocessing.get_context('fork').Pool(workers)
+
+    # No fork (e.g. Windows), send the trie once per worker instead
+    return multiprocessing.Pool(workers, initializer=_init_worker, initargs=(trie,))
+
+
+def _count_byte_range(args):
+    filename, start, end, candidate_count, itemset_length = args
+    return _count_transactions(_worker_trie, _read_byte_range(filename, start, end), candidate_count, itemset_length)
 
 
 class Apriori(object):
-    def __init__(self, min_support, input_filename, output_filename):
+    def __init__(self, min_support, input_filename, output_filename, workers=1):
+        # itemset -> support count, support itself is calculated when it's needed
         self._freq_dict = {}
         self._total_transaction_count = 0
         self._min_support = int(min_support)
         self._input_filename = input_filename
         self._output_filename = output_filename
+        # Number of processes to count candidate supports with
+        self._workers = workers
 
     def _ready(self):
         print('Ready...')
@@ -26,45 +123,77 @@ class Apriori(object):
 
                 for number in numbers:
                     key = frozenset([number])
-                    if not self._freq_dict.get(key):
-                        data = {
-                            'freq': 1,
-                            'support': 0,
-                            'itemsets': []
-                        }
-                        self._freq_dict[key] = data
-                    else:
-                        updated_freq = self._freq_dict[key]['freq'] + 1
-                        data = {
-                            'freq': updated_freq,
-                            'support': updated_freq / line_count * 100
-                        }
-                        self._freq_dict[key].update(data)
+                    self._freq_dict[key] = self._freq_dict.get(key, 0) + 1
 
             self._total_transaction_count = line_count
 
     def _generate_candidates(self, itemset_length):
-        candidates = []
+        """Join frequent (itemset_length - 1)-itemsets sharing a prefix and prune ones with an infrequent subset"""
+        frequent_itemsets = []
         for k in self._freq_dict.keys():
             if len(k) != (itemset_length - 1):
                 continue
 
-            if self._freq_dict[k]['support'] >= self._min_support:
-                candidates.append(k)
+            if self._is_frequent(self._freq_dict[k]):
+                frequent_itemsets.append(tuple(sorted(k)))
 
-        candidates = frozenset().union(*candidates)
-        combinations = itertools.combinations(candidates, itemset_length)
+        frequent_itemsets.sort()
+        frequent_itemset_set = set(frequent_itemsets)
 
-        # Convert tuples into set list
         new_candidates = []
-        for k, t in enumerate(combinations):
-            new_candidates.append(frozenset(t))
+        for idx, itemset in enumerate(frequent_itemsets):
+            for other_itemset in frequent_itemsets[idx + 1:]:
+                # Itemsets with the same prefix are next to each other
+                if itemset[:-1] != other_itemset[:-1]:
+                    break
 
-        del combinations
+                candidate = itemset + other_itemset[-1:]
+                subsets = itertools.combinations(candidate, itemset_length - 1)
+                if all(subset in frequent_itemset_set for subset in subsets):
+                    new_candidates.append(frozenset(candidate))
 
         return new_candidates
 
+    def _count_candidates(self, candidates, itemset_length):
+        """Return support counts of candidates and indices of them by order of their first appearance"""
+        trie = CandidateTrie(candidates, itemset_length)
+        if self._workers > 1:
+            counts, first_appearance_keys = self._count_candidates_in_parallel(trie, len(candidates), itemset_length)
+        else:
+            with open(self._input_filename, 'r') as f:
+                counts, first_appearance_keys = _count_transactions(trie, f, len(candidates), itemset_length)
+
+        # Candidates appeared in the same transaction are ordered like candidates list
+        first_appearances = [x for x in range(len(candidates)) if counts[x] > 0]
+        first_appearances.sort(key=lambda x: first_appearance_keys[x])
+
+        return counts, first_appearances
+
+    def _count_candidates_in_parallel(self, trie, candidate_count, itemset_length):
+        """Count candidates on byte ranges of the input in a process pool and merge the counts"""
+        file_size = os.path.getsize(self._input_filename)
+        # A few ranges per worker to even out the load
+        range_count = self._workers * 4
+        bounds = [file_size * x // range_count for x in range(range_count + 1)]
+        tasks = [(self._input_filename, bounds[x], bounds[x + 1], candidate_count, itemset_length)
+                 for x in range(range_count)]
+
+        counts = array('q', [0]) * candidate_count
+        # (range index, line index in the range) of the first appearance
+        first_appearance_keys = [None] * candidate_count
+        with _create_worker_pool(trie, self._workers) as pool:
+            for range_idx, (range_counts, first_lines) in enumerate(pool.imap(_count_byte_range, tasks)):
+                for idx in range(candidate_count):
+                    if range_counts[idx] == 0:
+                        continue
+                    if counts[idx] == 0:
+                        first_appearance_keys[idx] = (range_idx, first_lines[idx])
+                    counts[idx] += range_counts[idx]
+
+        return counts, first_appearance_keys
+
     def _apriori(self):
+        """Yield counted itemsets of each level, longer itemsets are counted only when the next one is asked"""
         iteration = 1
 
         while True:
@@ -76,55 +205,102 @@ class Apriori(object):
             if not candidates:
                 break
 
-            with open(self._input_filename, 'r') as f:
-                for n, line in enumerate(f):
-                    numbers = frozenset(map(int, line.strip().split('\t')))
+            counts, first_appearances = self._count_candidates(candidates, iteration)
+            yield self._add_counted_candidates(candidates, counts, first_appearances)
 
-                    if len(numbers) < iteration:
-                        continue
+    def _add_counted_candidates(self, candidates, counts, first_appearances):
+        """Add candidates appeared in transactions into _freq_dict by order of their first appearance, return them"""
+        counted = [candidates[idx] for idx in first_appearances]
+        for idx, itemset in zip(first_appearances, counted):
+            self._freq_dict[itemset] = counts[idx]
 
-                    for candidate in candidates:
-                        if candidate.issubset(numbers):
-                            if not self._freq_dict.get(candidate):
-                                data = {
-                                    'freq': 1,
-                                    'support': 0,
-                                    'itemsets': []
-                                }
-                                self._freq_dict[candidate] = data
-                            else:
-                                updated_freq = self._freq_dict[candidate]['freq'] + 1
-                                data = {
-                                    'freq': updated_freq,
-                                    'support': updated_freq / self._total_transaction_count * 100
-                                }
-                                self._freq_dict[candidate].update(data)
-
-                            del data
-
-                            for k in self._freq_dict.keys():
-                                if k.issubset(candidate) and k != candidate:
-                                    self._freq_dict[k]['itemsets'].append(candidate)
-
-                    del numbers
-
-    def _print(self):
-        with open(self._output_filename, 'w') as f:
-            for freq, v in self._freq_dict.items():
-                for itemset in set(v['itemsets']):
-                    association = itemset - freq
-
-                    formatted_support = self._format_float_number(self._freq_dict[itemset]['support'])
-                    confidence = self._freq_dict[itemset]['freq'] / v['freq'] * 100
-                    formatted_confidence = self._format_float_number(confidence)
-
-                    if formatted_support >= self._min_support:
-                        f.write('{}\t{}\t{:.2f}\t{:.2f}'.format(
-                            self._format_itemsets(freq),
-                            self._format_itemsets(association),
+        return counted
+
+    def _get_support(self, count):
+        """Return support of an itemset counted count times as it is written, in hundredths"""
+        if count == 1:
+            # An itemset seen once has always had support 0
+            return 0
+        return self._round_percentage(count, self._total_transaction_count)
+
+    def _is_frequent(self, count):
+        # Support as it is written, rounded to hundredths, so that every itemset whose rules are written
+        # is mined (e.g. 3.996% is written as 4.00 and frequent with min support 4)
+        return self._get_support(count) >= self._min_support * 100
+
+    def _get_min_count(self):
+        """Return the smallest count whose rounded support is at least min support"""
+        if not self._total_transaction_count:
+            # Nothing to mine in an empty input
+            return 1
+
+        # Rounded half up, the support reaches min support from min support - 0.005
+        min_count = max(1, -(-(self._min_support * 200 - 1) * self._total_transaction_count // 20000))
+        # An exact tie may be rounded down
+        while not self._is_frequent(min_count):
+            min_count += 1
+
+        return min_count
+
+    def _set_frequent_itemsets(self, found):
+        """Replace _freq_dict with given frequent itemset -> count, for engines mining all itemsets at once,
+        and return the itemsets grouped by length
+        """
+        self._freq_dict = {}
+        levels = []
+        for itemset in sorted(found.keys(), key=lambda x: (len(x), sorted(x))):
+            self._freq_dict[itemset] = found[itemset]
+            if len(itemset) > len(levels):
+                levels.append([])
+            levels[-1].append(itemset)
+
+        return levels
+
+    def _generate_rules(self, levels):
+        """Yield output lines of every split of frequent itemsets, a level at a time as levels are mined
+
+        Lines are grouped by itemset, itemsets by length and then by their sorted items, so every engine writes
+        the same file. Rules of an itemset go by subset size, then as itertools.combinations of its sorted items.
+        """
+        min_support = self._min_support * 100
+        # Formatted itemsets of the previous levels, every rule's subset and association is one of them
+        formatted = {}
+        for level in levels:
+            for itemset in sorted(level, key=sorted):
+                formatted[itemset] = self._format_itemsets(itemset)
+                if len(itemset) < 2:
+                    continue
+
+                freq = self._freq_dict[itemset]
+                support = self._get_support(freq)
+                if support < min_support:
+                    continue
+
+                formatted_support = self._format_hundredths(support)
+                items = sorted(itemset)
+                for length in range(1, len(items)):
+                    for subset in itertools.combinations(items, length):
+                        subset = frozenset(subset)
+                        association = itemset - subset
+                        # Every subset of a counted itemset has been counted in the previous levels
+                        confidence = self._round_percentage(freq, self._freq_dict[subset])
+                        yield '{}\t{}\t{}\t{}\n'.format(
+                            formatted[subset],
+                            formatted[association],
                             formatted_support,
-                            formatted_confidence
-                        ) + '\n')
+                            self._format_hundredths(confidence)
+                        )
+
+    def _print(self, lines, buffer_size=1 << 16):
+        """Write lines to the output file, buffer_size lines per write"""
+        with open(self._output_filename, 'w') as f:
+            buffer = []
+            for line in lines:
+                buffer.append(line)
+                if len(buffer) >= buffer_size:
+                    f.write(''.join(buffer))
+                    buffer = []
+            f.write(''.join(buffer))
 
     @staticmethod
     def _format_itemsets(itemset):
@@ -134,16 +310,273 @@ class Apriori(object):
         return '{{{}}}'.format(','.join(str(x) for x in new_itemset))
 
     @staticmethod
-    def _format_float_number(number):
-        return Decimal(number).quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
+    def _round_percentage(numerator, denominator):
+        """Return numerator / denominator * 100 rounded half up to hundredths, as an integer number of hundredths"""
+        hundredths, remainder = divmod(numerator * 10000, denominator)
+        if remainder * 2 == denominator:
+            # An exact tie, round the float percentage like the output always has been
+            # (e.g. 29 / 800 * 100 is 3.6249999... and had been written as 3.62)
+            return hundredths + (Fraction(numerator / denominator * 100) >= Fraction(2 * hundredths + 1, 200))
+        return hundredths + (remainder * 2 > denominator)
+
+    @staticmethod
+    def _format_hundredths(number):
+        return '{}.{:02d}'.format(number // 100, number % 100)
+
+    def _mine(self):
+        """Return an iterator of itemsets of each level whose counts are final"""
+        # Length-1 itemsets are counted in _ready
+        yield [k for k in self._freq_dict.keys() if len(k) == 1]
+        for level in self._apriori():
+            yield level
 
     def run(self):
         # Calculate total transaction count and make a base length-1 itemsets
         self._ready()
-        self._apriori()
-        self._print()
+        # Rules of a level are written while the next level is being mined
+        self._print(self._generate_rules(self._mine()))
+
+
+class FPNode(object):
+    def __init__(self, item, parent):
+        self.item = item
+        self.count = 0
+        self.parent = parent
+        self.children = {}
+
+
+class TransactionFile(object):
+    """Transactions of a file as (items, count=1), every iteration reads the file again"""
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    def __iter__(self):
+        with open(self._filename, 'r') as f:
+            for line in f:
+                yield set(map(int, line.strip().split('\t'))), 1
+
+
+class FPTree(object):
+    """Prefix tree of transactions whose items are ordered by descending frequency"""
+
+    def __init__(self, weighted_transactions, min_count, item_counts=None):
+        # Without given item counts, weighted_transactions is iterated twice: to count items and to build the tree
+        if item_counts is None:
+            item_counts = FPTree.count_items(weighted_transactions)
+        # Keep frequent items only
+        self.item_counts = {k: v for k, v in item_counts.items() if v >= min_count}
+
+        # Most frequent item comes first, so that transactions share the paths as much as possible
+        order = sorted(self.item_counts.keys(), key=lambda x: (-self.item_counts[x], x))
+        self._rank = {item: rank for rank, item in enumerate(order)}
+
+        self.root = FPNode(None, None)
+        # item -> all nodes of the item
+        self.header = {item: [] for item in order}
+        for items, count in weighted_transactions:
+            self._insert(sorted((x for x in items if x in self._rank), key=self._rank.get), count)
+
+    @staticmethod
+    def count_items(weighted_transactions):
+        item_counts = {}
+        for items, count in weighted_transactions:
+            for item in items:
+                item_counts[item] = item_counts.get(item, 0) + count
+
+        return item_counts
+
+    def _insert(self, items, count):
+        node = self.root
+        for item in items:
+            child = node.children.get(item)
+            if child is None:
+                child = FPNode(item, node)
+                node.children[item] = child
+                self.header[item].append(child)
+            child.count += count
+            node = child
+
+    def get_prefix_paths(self, item):
+        """Return (items on the path from root, count) of each node of given item"""
+        paths = []
+        for node in self.header[item]:
+            path = []
+            parent = node.parent
+            while parent.item is not None:
+                path.append(parent.item)
+                parent = parent.parent
+            paths.append((path, node.count))
+
+        return paths
+
+    def mine(self, suffix, min_count, found):
+        """Add every frequent itemset ending with given suffix into found as itemset -> count"""
+        # Least frequent item first
+        for item in sorted(self.item_counts.keys(), key=lambda x: (self.item_counts[x], x)):
+            itemset = suffix | {item}
+            found[itemset] = self.item_counts[item]
+
+            conditional_tree = FPTree(self.get_prefix_paths(item), min_count)
+            if conditional_tree.item_counts:
+                conditional_tree.mine(itemset, min_count, found)
+
+
+class FPGrowth(Apriori):
+    """Mine frequent itemsets with FP-Growth, which reads the input twice and generates no candidates"""
+
+    def __init__(self, min_support, input_filename, output_filename, workers=1):
+        super(FPGrowth, self).__init__(min_support, input_filename, output_filename, workers)
+        self._item_counts = {}
+
+    def _ready(self):
+        # First pass: count transactions and items
+        print('Ready...')
+        for items, count in TransactionFile(self._input_filename):
+            self._total_transaction_count += count
+            for item in items:
+                self._item_counts[item] = self._item_counts.get(item, 0) + count
+
+    def _mine(self):
+        min_count = self._get_min_count()
+
+        # Second pass: build the tree
+        print('Build FP-tree')
+        tree = FPTree(TransactionFile(self._input_filename), min_count, self._item_counts)
+
+        print('Mine FP-tree')
+        found = {}
+        tree.mine(frozenset(), min_count, found)
+        for level in self._set_frequent_itemsets(found):
+            yield level
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+
+
+def _lowest_bit(bits):
+    """Return index of the lowest set bit, -1 if there's none"""
+    return (bits & -bits).bit_length() - 1
+
+
+class TidsetApriori(Apriori):
+    """Apriori on a vertical layout: the input is read once into a transaction id bitset per item
+    and candidate supports come from bitwise AND of the bitsets
+    """
+
+    def __init__(self, min_support, input_filename, output_filename, workers=1):
+        super(TidsetApriori, self).__init__(min_support, input_filename, output_filename, workers)
+        # item -> bitset of transaction ids (Python int, bit n is the n-th transaction)
+        self._item_tidsets = {}
+
+    def _ready(self):
+        print('Ready...')
+        item_tids = {}
+        with open(self._input_filename, 'r') as f:
+            for tid, line in enumerate(f):
+                for number in set(map(int, line.strip().split('\t'))):
+                    item_tids.setdefault(number, []).append(tid)
+                self._total_transaction_count = tid + 1
+
+        bitset_size = (self._total_transaction_count + 7) // 8
+        for number, tids in item_tids.items():
+            bits = bytearray(bitset_size)
+            for tid in tids:
+                bits[tid >> 3] |= 1 << (tid & 7)
+            self._item_tidsets[number] = int.from_bytes(bytes(bits), 'little')
+
+            self._freq_dict[frozenset([number])] = len(tids)
+
+    def _apriori(self):
+        iteration = 1
+        # Bitsets of the previous level's itemsets, a candidate is its prefix's bitset AND its last item's
+        tidsets = {(k,): v for k, v in self._item_tidsets.items()}
+
+        while True:
+            iteration += 1
+
+            print('Run apriori iter#', iteration)
+            candidates = self._generate_candidates(iteration)
+            print('Candidates: ', len(candidates))
+            if not candidates:
+                break
+
+            counts = []
+            first_tids = []
+            next_tidsets = {}
+            for candidate in candidates:
+                items = tuple(sorted(candidate))
+                tidset = tidsets[items[:-1]] & self._item_tidsets[items[-1]]
+                next_tidsets[items] = tidset
+                counts.append(_popcount(tidset))
+                first_tids.append(_lowest_bit(tidset))
+            tidsets = next_tidsets
+
+            # Same order as counting transaction by transaction
+            first_appearances = [x for x in range(len(candidates)) if counts[x] > 0]
+            first_appearances.sort(key=lambda x: first_tids[x])
+            yield self._add_counted_candidates(candidates, counts, first_appearances)
+
+
+class Eclat(TidsetApriori):
+    """Depth-first mining of frequent itemsets by intersecting bitsets of itemsets sharing a prefix"""
+
+    def _eclat(self, prefix, extensions, min_count, found):
+        """extensions are (item, tidset, count) of frequent itemsets of prefix and an item"""
+        for idx, (item, tidset, count) in enumerate(extensions):
+            itemset = prefix | {item}
+            found[itemset] = count
+
+            next_extensions = []
+            for other_item, other_tidset, _ in extensions[idx + 1:]:
+                next_tidset = tidset & other_tidset
+                next_count = _popcount(next_tidset)
+                # Same cutoff as _is_frequent, min support as the rounded support is written
+                if next_count >= min_count:
+                    next_extensions.append((other_item, next_tidset, next_count))
+
+            if next_extensions:
+                self._eclat(itemset, next_extensions, min_count, found)
+
+    def _mine(self):
+        print('Run eclat')
+        min_count = self._get_min_count()
+        # Item counts are known since _ready
+        extensions = sorted(
+            (item, tidset, self._freq_dict[frozenset([item])]) for item, tidset in self._item_tidsets.items()
+            if self._freq_dict[frozenset([item])] >= min_count
+        )
+
+        found = {}
+        self._eclat(frozenset(), extensions, min_count, found)
+        for level in self._set_frequent_itemsets(found):
+            yield level
+
+
+ENGINES = {
+    'apriori': Apriori,
+    'tidset': TidsetApriori,
+    'eclat': Eclat,
+    'fpgrowth': FPGrowth
+}
+
 
 if __name__ == '__main__':
-    _, min_support, input_filename, output_filename = sys.argv
-    apriori = Apriori(min_support, input_filename, output_filename)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('min_support')
+    parser.add_argument('input_filename')
+    parser.add_argument('output_filename')
+    parser.add_argument('-e', '--engine', choices=sorted(ENGINES.keys()), default='apriori',
+                        help='apriori, tidset (apriori on transaction id bitsets, same output), '
+                             'eclat or fpgrowth (default: apriori)')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of processes to count supports with, apriori engine only (default: 1)')
+    args = parser.parse_args()
+
+    apriori = ENGINES[args.engine](args.min_support, args.input_filename, args.output_filename, args.workers)
     apriori.run()
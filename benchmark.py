@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""Accuracy and performance benchmark of all assignments.
+
+Runs each assignment on its bundled data inside a temporary directory, measures wall time and
+peak traced memory of its public entry point and of each phase and writes the results as JSON so
+that two versions can be compared with --compare (--scripts-dir runs another checkout).
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RECOMMENDER_FOLDS = ['u1', 'u2', 'u3', 'u4', 'u5']
+# input filename, cluster count, eps, min_pts
+DBSCAN_CASES = [('input1.txt', 8, 15, 22), ('input2.txt', 5, 2, 7), ('input3.txt', 4, 5, 5)]
+# train filename, test filename
+DT_CASES = [('dt_train.txt', 'dt_test.txt'), ('dt_train1.txt', 'dt_test1.txt')]
+APRIORI_MIN_SUPPORTS = [4, 5]
+
+
+def _import_script(scripts_dir, dirname, name):
+    """Import an assignment script as a module, the directories are not packages"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(scripts_dir, dirname, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Process pools of the scripts pickle their functions by module name
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _get_options(**options):
+    """Return keyword arguments which are not the default, older scripts do not take them"""
+    return {k: v for k, (v, default) in options.items() if v != default}
+
+
+class PhaseTimer(object):
+    """Measure wall time and peak traced memory of consecutive phases"""
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Memory is only known while tracemalloc is tracing, which slows down allocations a lot
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start_memory, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        # Keep the scripts' progress messages out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+        elapsed = time.perf_counter() - start
+
+        self.phases[name] = {'time': elapsed, 'peak_memory': None}
+        if tracing:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            self.phases[name]['peak_memory'] = max(0, peak_memory - start_memory)
+
+    def run_phases(self, phases):
+        """Time (name, function) phases calling private methods of a script, skip them all if a version
+        of the script has other ones, the public entry point is timed separately anyway
+        """
+        timer = PhaseTimer()
+        try:
+            for name, function in phases:
+                with timer.phase(name):
+                    function()
+        except (AttributeError, TypeError) as e:
+            print('No phase breakdown for this version: {}'.format(e), file=sys.stderr)
+            return
+
+        self.phases.update(timer.phases)
+
+
+def score_predictions(prediction_filename, test_filename):
+    """Yield running (count, RMSE, MAE) by streaming prediction and test files side by side"""
+    count = 0
+    sq_error_sum = abs_error_sum = 0
+    with open(prediction_filename, 'r') as predictions, open(test_filename, 'r') as tests:
+        for prediction_line, test_line in zip(predictions, tests):
+            # data format [user_id]\t[item_id]\t[rating] / [user_id]\t[item_id]\t[rating]\t[time_stamp]
+            error = int(prediction_line.split('\t')[2]) - int(test_line.split('\t')[2])
+            count += 1
+            sq_error_sum += error ** 2
+            abs_error_sum += abs(error)
+
+            yield count, math.sqrt(sq_error_sum / count), abs_error_sum / count
+
+
+def benchmark_recommender(scripts_dir, work_dir, modes):
+    recommender = _import_script(scripts_dir, 'predict-ratings', 'recommender')
+    for fold in RECOMMENDER_FOLDS:
+        train_filename = os.path.join(work_dir, fold + '.base')
+        test_filename = os.path.join(work_dir, fold + '.test')
+        shutil.copy(os.path.join(scripts_dir, 'predict-ratings', fold + '.base'), train_filename)
+        shutil.copy(os.path.join(scripts_dir, 'predict-ratings', fold + '.test'), test_filename)
+
+        for mode in modes:
+            options = _get_options(mode=(mode, 'user'))
+            timer = PhaseTimer()
+            with timer.phase('run'):
+                recommender.Recommender(train_filename, test_filename, **options).run()
+
+            metrics = {}
+            prediction_filename = os.path.join(work_dir, fold + '.base_prediction.txt')
+            for count, rmse, mae in score_predictions(prediction_filename, test_filename):
+                metrics = {'count': count, 'rmse': rmse, 'mae': mae}
+
+            r = recommender.Recommender(train_filename, test_filename, **options)
+            timer.run_phases([
+                ('load', lambda: r._load_ratings()),
+                ('similarity', lambda: (r._calculate_similarity(), r._build_neighbor_index())),
+                ('predict', lambda: r._predict())
+            ])
+
+            yield '{}/{}'.format(fold, mode), timer.phases, metrics
+
+
+def benchmark_apriori(scripts_dir, work_dir, input_filename, engines):
+    if input_filename is None or not os.path.exists(input_filename):
+        print('Skipping apriori: no input file, use --apriori-input', file=sys.stderr)
+        return
+
+    apriori = _import_script(scripts_dir, 'apriori', 'apriori')
+    # Versions before the other engines have Apriori only
+    classes = getattr(apriori, 'ENGINES', {'apriori': apriori.Apriori})
+    for min_support in APRIORI_MIN_SUPPORTS:
+        for engine in engines:
+            if engine not in classes:
+                print('Skipping apriori engine {}: not in this version'.format(engine), file=sys.stderr)
+                continue
+
+            output_filename = os.path.join(work_dir, 'output{}_{}.txt'.format(min_support, engine))
+            timer = PhaseTimer()
+            with timer.phase('run'):
+                classes[engine](min_support, input_filename, output_filename).run()
+
+            with open(output_filename, 'r') as f:
+                rule_count = sum(1 for _ in f)
+
+            a = classes[engine](min_support, input_filename, output_filename)
+            timer.run_phases([
+                ('ready', lambda: a._ready()),
+                # Rules are written while mining, level by level
+                ('mine_and_print', lambda: a._print(a._generate_rules(a._mine())))
+            ])
+
+            yield 'support_{}/{}'.format(min_support, engine), timer.phases, {'rules': rule_count}
+
+
+def benchmark_dbscan(scripts_dir, work_dir, extra_cases, worker_counts):
+    clustering = _import_script(scripts_dir, 'DBSCAN', 'clustering')
+    cases = [(os.path.join(scripts_dir, 'DBSCAN', x[0]),) + x[1:] for x in DBSCAN_CASES] + extra_cases
+    for input_filename, cluster_count, eps, min_pts in cases:
+        path = os.path.join(work_dir, os.path.basename(input_filename))
+        shutil.copy(input_filename, path)
+
+        for workers in worker_counts:
+            builder = clustering.DBSCANClusterBuilder(
+                path, cluster_count, eps, min_pts, **_get_options(workers=(workers, 1))
+            )
+            timer = PhaseTimer()
+            with timer.phase('run'):
+                builder.run()
+
+            metrics = {
+                'clusters': len(builder.clusters),
+                'noises': len(builder.noises)
+            }
+            case = os.path.splitext(os.path.basename(input_filename))[0]
+            if workers > 1:
+                case += '/j{}'.format(workers)
+            yield case, timer.phases, metrics
+
+
+def benchmark_dt(scripts_dir, work_dir, worker_counts):
+    dt = _import_script(scripts_dir, 'decision-tree', 'dt')
+    for train_filename, test_filename in DT_CASES:
+        output_filename = os.path.join(work_dir, train_filename + '.result')
+        for workers in worker_counts:
+            options = _get_options(workers=(workers, 1))
+            args = (
+                os.path.join(scripts_dir, 'decision-tree', train_filename),
+                os.path.join(scripts_dir, 'decision-tree', test_filename),
+                output_filename
+            )
+            timer = PhaseTimer()
+            with timer.phase('run'):
+                dt.DecisionTreeBuilder(*args, **options).run()
+
+            state = {}
+            timer.run_phases([
+                ('load', lambda: state.update(builder=dt.DecisionTreeBuilder(*args))),
+                ('build', lambda: state.update(tree=state['builder']._build_tree(
+                    state['builder'].initial_train_set, state['builder'].initial_attributes, **options
+                ))),
+                ('classify', lambda: state['builder'].classify(state['tree']))
+            ])
+
+            case = os.path.splitext(train_filename)[0]
+            if workers > 1:
+                case += '/j{}'.format(workers)
+            yield case, timer.phases, {}
+
+
+def _get_total_time(phases):
+    """Return time of the phases other than the whole run, which is their sum"""
+    return sum(v['time'] for k, v in phases.items() if k != 'run')
+
+
+def compare(results, baseline_results, tolerance, min_time):
+    """Print phases which got slower than the baseline and what could not be compared,
+    return whether there was any slower one
+    """
+    baseline = {(x['suite'], x['case']): x for x in baseline_results}
+    regressed = False
+    for result in results:
+        old = baseline.pop((result['suite'], result['case']), None)
+        if old is None:
+            print('Not in the baseline: {}/{}'.format(result['suite'], result['case']), file=sys.stderr)
+            continue
+
+        phases = dict(result['phases'])
+        old_phases = dict(old['phases'])
+        # Phases are renamed or dropped as the scripts change, their total still tells the whole time
+        if any(x != 'run' for x in phases) and any(x != 'run' for x in old_phases):
+            phases['total'] = {'time': _get_total_time(phases)}
+            old_phases['total'] = {'time': _get_total_time(old_phases)}
+
+        for name in sorted(set(phases) ^ set(old_phases)):
+            print('Phase {} of {}/{} is only in the {}'.format(
+                name, result['suite'], result['case'], 'baseline' if name in old_phases else 'result'
+            ), file=sys.stderr)
+
+        for name, phase in phases.items():
+            old_phase = old_phases.get(name)
+            # Too short phases are mostly noise
+            if old_phase is None or max(old_phase['time'], phase['time']) < min_time:
+                continue
+
+            ratio = phase['time'] / old_phase['time']
+            if ratio > 1 + tolerance:
+                regressed = True
+                print('Regression: {}/{} {} {:.3f}s -> {:.3f}s ({:.2f}x)'.format(
+                    result['suite'], result['case'], name, old_phase['time'], phase['time'], ratio
+                ), file=sys.stderr)
+
+    # Suites which were not run are not missing
+    suites = set(x['suite'] for x in results)
+    for suite, case in sorted(baseline):
+        if suite in suites:
+            print('Not in the result: {}/{}'.format(suite, case), file=sys.stderr)
+
+    return regressed
+
+
+def _format_phase(name, phase):
+    if phase['peak_memory'] is None:
+        return '{}={:.3f}s'.format(name, phase['time'])
+    return '{}={:.3f}s/{:.1f}MB'.format(name, phase['time'], phase['peak_memory'] / 2 ** 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='recommender, apriori, dbscan or dt (default: all)')
+    parser.add_argument('-o', '--output', default=None, help='JSON result filename (default: stdout)')
+    parser.add_argument('--compare', default=None, help='JSON result of a baseline run to check against')
+    parser.add_argument('--scripts-dir', default=BASE_DIR,
+                        help='root of the assignments to run, e.g. a checkout of an older version (default: here)')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown ratio of a phase against the baseline (default: 0.2)')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='ignore phases shorter than this (sec) when comparing (default: 0.05)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace memory, tracing slows down allocation heavy phases')
+    parser.add_argument('--recommender-modes', nargs='+', default=['user'], choices=['user', 'item'])
+    parser.add_argument('--apriori-engines', nargs='+', default=['apriori'],
+                        choices=['apriori', 'tidset', 'eclat', 'fpgrowth'])
+    parser.add_argument('--apriori-input', default=os.path.join(BASE_DIR, 'apriori', 'input.txt'),
+                        help='transaction file for apriori (not bundled)')
+    parser.add_argument('--dbscan-workers', nargs='+', type=int, default=[1],
+                        help='numbers of processes to run DBSCAN with, to see how it scales (default: 1)')
+    parser.add_argument('--dbscan-case', nargs=4, action='append', default=[],
+                        metavar=('FILENAME', 'CLUSTER_COUNT', 'EPS', 'MIN_PTS'),
+                        help='additional DBSCAN input, e.g. a large one to see the parallel scaling')
+    parser.add_argument('--dt-workers', nargs='+', type=int, default=[1],
+                        help='numbers of processes to build decision trees with (default: 1)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    suites = {
+        'recommender': lambda: benchmark_recommender(args.scripts_dir, work_dir, args.recommender_modes),
+        'apriori': lambda: benchmark_apriori(args.scripts_dir, work_dir, args.apriori_input, args.apriori_engines),
+        'dbscan': lambda: benchmark_dbscan(
+            args.scripts_dir, work_dir, [tuple(x) for x in args.dbscan_case], args.dbscan_workers
+        ),
+        'dt': lambda: benchmark_dt(args.scripts_dir, work_dir, args.dt_workers)
+    }
+
+    for suite in args.suites:
+        if suite not in suites:
+            parser.error('unknown suite: ' + suite)
+
+    results = []
+    if not args.no_memory:
+        tracemalloc.start()
+    try:
+        for suite in args.suites or ['recommender', 'apriori', 'dbscan', 'dt']:
+            for case, phases, metrics in suites[suite]():
+                results.append({'suite': suite, 'case': case, 'phases': phases, 'metrics': metrics})
+
+                # Stream a summary of each case as soon as it is done
+                print('{:<12}{:<20}{}  {}'.format(
+                    suite,
+                    case,
+                    ' '.join(_format_phase(k, v) for k, v in phases.items()),
+                    ' '.join('{}={:.4g}'.format(k, v) for k, v in metrics.items())
+                ), file=sys.stderr)
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(work_dir)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            if compare(results, json.load(f)['results'], args.tolerance, args.min_time):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 from __future__ import division
 
+import argparse
+import itertools
 import math
-import sys
-from collections import Counter, OrderedDict
+import multiprocessing
+import operator
+import os
+import queue
+from collections import OrderedDict
+
+import numpy as np
+
+# Version of the saved model format, bump on incompatible changes
+MODEL_VERSION = 3
 
 
 class Node(object):
@@ -41,15 +51,234 @@ class ClassNode(Node):
         return self.value
 
 
+class EncodedDataSet(object):
+    """Train set as a matrix of integer codes, a row per attribute (the class is the last one)"""
+
+    def __init__(self, train_set, attribute_count):
+        self.codes = np.zeros((attribute_count, len(train_set)), dtype=np.int64)
+        # Values of each attribute by code, codes follow the sorted order of the values
+        self.values = []
+        for attr_idx in range(attribute_count):
+            column = list(map(operator.itemgetter(attr_idx), train_set))
+            values = sorted(set(column))
+            codes = {x: code for code, x in enumerate(values)}
+
+            self.values.append(values)
+            self.codes[attr_idx] = np.array(list(map(codes.__getitem__, column)), dtype=np.int64)
+
+        # Offset of each attribute's value x class cells in a combined contingency table
+        self.class_count = len(self.values[-1])
+        cell_counts = [len(x) * self.class_count for x in self.values[:-1]]
+        self.cell_offsets = np.cumsum([0] + cell_counts).tolist()
+
+
+def _pack_strings(strings):
+    """Return strings as UTF-8 bytes joined by tabs, which values read from tab separated lines never have"""
+    return np.frombuffer('\t'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def _unpack_strings(packed, count):
+    return packed.tobytes().decode('utf-8').split('\t') if count else []
+
+
+def _narrow(array):
+    """Return array in the smallest integer type holding its values"""
+    if not len(array):
+        return array.astype(np.int8)
+    return array.astype(np.promote_types(np.min_scalar_type(array.min()), np.min_scalar_type(array.max())))
+
+
+class CompiledTree(object):
+    """Decision tree as flat arrays, to classify a batch of rows a tree level at a time
+
+    A row takes the child of the criteria matching its value, or the criteria with the most train data
+    when none matches, whose name replaces the value in the row.
+    """
+
+    def __init__(self, attributes, values, class_values, node_attributes, node_classes, edge_offsets, edge_codes,
+                 edge_children, default_children, default_codes):
+        # Names of attributes and the criteria names of each by code
+        self.attributes = attributes
+        self.values = values
+        self.class_values = class_values
+        # Attribute each node tests (-1 for class nodes) and the class of class nodes
+        self.node_attributes = node_attributes
+        self.node_classes = node_classes
+        # Criteria of attribute nodes (CSR): codes of criteria names of node n by ascending order and their
+        # children are in edge_offsets[n]:edge_offsets[n + 1]
+        self.edge_offsets = edge_offsets
+        self.edge_codes = edge_codes
+        self.edge_children = edge_children
+        # Child taken and code of the criteria name written into the row when no criteria matches
+        self.default_children = default_children
+        self.default_codes = default_codes
+
+        self._value_codes = [{x: code for code, x in enumerate(x)} for x in values]
+        # Sorted (node, code) keys of the edges to look them up all at once
+        self._key_base = max([len(x) for x in values] + [0]) + 1
+        edge_nodes = np.repeat(np.arange(len(node_attributes)), np.diff(edge_offsets))
+        self._edge_keys = edge_nodes * self._key_base + edge_codes
+
+    @staticmethod
+    def from_tree(tree, attributes):
+        """Compile a tree of nodes, attributes are names of the train set columns"""
+        # Number nodes breadth first, the root is 0
+        nodes = [tree]
+        for node in nodes:
+            if isinstance(node, AttributeNode):
+                nodes.extend(x.attribute_node or x.class_node for x in node.criteria)
+        node_ids = {id(node): node_id for node_id, node in enumerate(nodes)}
+
+        value_codes = [{} for _ in attributes]
+        node_attributes = [-1] * len(nodes)
+        node_classes = [0] * len(nodes)
+        edge_offsets = [0]
+        edge_codes = []
+        edge_children = []
+        default_children = [-1] * len(nodes)
+        default_codes = [-1] * len(nodes)
+        class_codes = {}
+        for node_id, node in enumerate(nodes):
+            if isinstance(node, ClassNode):
+                node_classes[node_id] = class_codes.setdefault(node.value, len(class_codes))
+                edge_offsets.append(len(edge_codes))
+                continue
+
+            # Criteria names of each attribute are coded by order of appearance
+            attr_idx = attributes.index(node.name)
+            codes = value_codes[attr_idx]
+            children = {}
+            for criteria in node.criteria:
+                # The first criteria wins if names are the same
+                children.setdefault(
+                    codes.setdefault(criteria.name, len(codes)),
+                    node_ids[id(criteria.attribute_node or criteria.class_node)]
+                )
+
+            # The first criteria with the most train data
+            default_code = codes[max(node.criteria, key=lambda x: x.data_count).name]
+
+            node_attributes[node_id] = attr_idx
+            for code in sorted(children):
+                edge_codes.append(code)
+                edge_children.append(children[code])
+            edge_offsets.append(len(edge_codes))
+            default_children[node_id] = children[default_code]
+            default_codes[node_id] = default_code
+
+        return CompiledTree(
+            list(attributes),
+            [sorted(x, key=x.get) for x in value_codes],
+            sorted(class_codes, key=class_codes.get),
+            np.array(node_attributes, dtype=np.int64),
+            np.array(node_classes, dtype=np.int64),
+            np.array(edge_offsets, dtype=np.int64),
+            np.array(edge_codes, dtype=np.int64),
+            np.array(edge_children, dtype=np.int64),
+            np.array(default_children, dtype=np.int64),
+            np.array(default_codes, dtype=np.int64)
+        )
+
+    def save(self, filename):
+        """Save the tree as an uncompressed .npz of the smallest integer arrays, strings are packed into bytes"""
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(
+                f,
+                version=np.array(MODEL_VERSION),
+                attributes=_pack_strings(self.attributes),
+                attribute_count=np.array(len(self.attributes)),
+                values=_pack_strings([x for values in self.values for x in values]),
+                value_counts=np.array([len(x) for x in self.values], dtype=np.int64),
+                class_values=_pack_strings(self.class_values),
+                class_count=np.array(len(self.class_values)),
+                node_attributes=_narrow(self.node_attributes),
+                node_classes=_narrow(self.node_classes),
+                edge_offsets=_narrow(self.edge_offsets),
+                edge_codes=_narrow(self.edge_codes),
+                edge_children=_narrow(self.edge_children),
+                default_children=_narrow(self.default_children),
+                default_codes=_narrow(self.default_codes)
+            )
+        # Never leave a half-written model
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as model:
+            version = int(model['version'])
+            if version != MODEL_VERSION:
+                raise ValueError('Unsupported model version {} of {}, expected {}'.format(
+                    version, filename, MODEL_VERSION
+                ))
+
+            value_counts = model['value_counts'].tolist()
+            values = _unpack_strings(model['values'], sum(value_counts))
+            value_offsets = np.cumsum([0] + value_counts).tolist()
+            return CompiledTree(
+                _unpack_strings(model['attributes'], int(model['attribute_count'])),
+                [values[start:end] for start, end in zip(value_offsets, value_offsets[1:])],
+                _unpack_strings(model['class_values'], int(model['class_count'])),
+                model['node_attributes'].astype(np.int64),
+                model['node_classes'].astype(np.int64),
+                model['edge_offsets'].astype(np.int64),
+                model['edge_codes'].astype(np.int64),
+                model['edge_children'].astype(np.int64),
+                model['default_children'].astype(np.int64),
+                model['default_codes'].astype(np.int64)
+            )
+
+    def classify(self, rows, header):
+        """Return class of each row (list of values under header) and indices of rows whose values are replaced"""
+        # Coded values of the tested attributes, an attribute's own unseen code for values not in the tree
+        attr_indices = [attr_idx for attr_idx, x in enumerate(self.values) if x]
+        columns = [header.index(self.attributes[x]) for x in attr_indices]
+        codes = np.zeros((len(attr_indices), len(rows)), dtype=np.int64)
+        for idx, (attr_idx, column) in enumerate(zip(attr_indices, columns)):
+            value_codes = self._value_codes[attr_idx]
+            values = map(operator.itemgetter(column), rows)
+            codes[idx] = np.fromiter(
+                map(value_codes.get, values, itertools.repeat(len(value_codes))), dtype=np.int64, count=len(rows)
+            )
+        code_indices = np.zeros(len(self.values), dtype=np.int64)
+        code_indices[attr_indices] = np.arange(len(attr_indices))
+        node_code_indices = code_indices[self.node_attributes]
+
+        nodes = np.zeros(len(rows), dtype=np.int64)
+        replaced = set()
+        active = np.flatnonzero(self.node_attributes[nodes] >= 0)
+        while len(active):
+            current = nodes[active]
+            keys = current * self._key_base + codes[node_code_indices[current], active]
+            positions = np.minimum(np.searchsorted(self._edge_keys, keys), len(self._edge_keys) - 1)
+            matched = self._edge_keys[positions] == keys
+
+            for row_idx, node_id in zip(active[~matched].tolist(), current[~matched].tolist()):
+                attr_idx = self.node_attributes[node_id]
+                rows[row_idx][columns[code_indices[attr_idx]]] = self.values[attr_idx][self.default_codes[node_id]]
+                replaced.add(row_idx)
+
+            nodes[active] = np.where(matched, self.edge_children[positions], self.default_children[current])
+            active = active[self.node_attributes[nodes[active]] >= 0]
+
+        return [self.class_values[x] for x in self.node_classes[nodes].tolist()], sorted(replaced)
+
+
 class DecisionTreeBuilder(object):
-    def __init__(self, train_set_filename, test_set_filename, output_filename):
+    def __init__(self, train_set_filename, test_set_filename, output_filename, model_filename=None, workers=1,
+                 parallel_rows=1000):
         self.train_set_filename = train_set_filename
         self.test_set_filename = test_set_filename
         self.output_filename = output_filename
+        self.model_filename = model_filename
+        self._workers = workers
+        # Subtrees of at least this many train rows are built by worker processes
+        self._parallel_rows = parallel_rows
         self.initial_train_set = []
         self.initial_attributes = []
 
-        self._load_data_set()
+        # There is nothing to train with if the model is loaded
+        if self.train_set_filename is not None:
+            self._load_data_set()
 
     def _load_data_set(self):
         with open(self.train_set_filename, 'r') as f:
@@ -71,181 +300,322 @@ class DecisionTreeBuilder(object):
         return info_value
 
     @staticmethod
-    def _get_info_d_value(train_set):
-        class_data = [x[-1] for x in train_set]
-        class_data.sort()
-
-        c = Counter(class_data)
-
-        return DecisionTreeBuilder._calculate_info_value(c.values())
+    def _get_class_counts(data_set, rows):
+        """Return count of each class in rows by code, which is the sorted order of the classes"""
+        return np.bincount(data_set.codes[-1, rows], minlength=data_set.class_count)
 
     @staticmethod
-    def _calculate_information_gains(train_set, attributes, info_d):
-        # Get all attributes without class attribute
-        attr_gains = {}
-        for attr in attributes:
-            attr_idx = attributes.index(attr)
+    def _get_info_d_value(class_counts):
+        # Classes by sorted order
+        return DecisionTreeBuilder._calculate_info_value([x for x in class_counts.tolist() if x > 0])
 
-            # find a distinct attributes for attribute from train_set
-            attr_data = [x[attr_idx] for x in train_set]
-            criteria_c = Counter(attr_data)
+    @staticmethod
+    def _calculate_information_gains(data_set, rows, attributes, attr_indices, info_d):
+        """Return attributes with descending information gain order
+
+        (value x class) counts of all attributes come from a single bincount, and the information of each
+        value is summed by order of first appearance like counting the rows one by one
+        """
+        codes = data_set.codes[:, rows]
+        offsets = np.array([data_set.cell_offsets[x] for x in attr_indices])
+        keys = (offsets[:, np.newaxis] + codes[attr_indices] * data_set.class_count + codes[-1]).ravel()
+        cell_counts = np.bincount(keys, minlength=data_set.cell_offsets[-1])
+        # First appearance of each (value, class), positions of an attribute's cells are in the row order
+        first_positions = np.full(data_set.cell_offsets[-1], keys.size, dtype=np.int64)
+        np.minimum.at(first_positions, keys, np.arange(keys.size))
+
+        # Tables are small, plain lists are faster than arrays from here
+        cell_counts = cell_counts.tolist()
+        first_positions = first_positions.tolist()
+
+        attr_gains = OrderedDict()
+        for attr, attr_idx in zip(attributes, attr_indices):
+            # (first position, class counts by order of first appearance) of each criteria in the rows
+            criteria = []
+            cell_start, cell_end = data_set.cell_offsets[attr_idx], data_set.cell_offsets[attr_idx + 1]
+            for start in range(cell_start, cell_end, data_set.class_count):
+                cells = [(first_positions[x], cell_counts[x]) for x in range(start, start + data_set.class_count)
+                         if cell_counts[x] > 0]
+                if cells:
+                    cells.sort()
+                    criteria.append((cells[0][0], [x[1] for x in cells]))
+            criteria.sort()
 
             info_attr = 0
             # Loop each criteria by distinct attribute data
-            for idx, criteria in enumerate(criteria_c.keys()):
-                class_list = []
-                for data in train_set:
-                    # To get class value from criteria in attr
-                    if data[attr_idx] == criteria:
-                        class_list.append(data[-1])
-
-                c = Counter(class_list)
-                count = list(criteria_c.values())[idx]
-                value = (count / len(attr_data))
-
-                info_attr += (value * DecisionTreeBuilder._calculate_info_value(c.values()))
+            for _, class_counts in criteria:
+                value = (sum(class_counts) / len(rows))
+                info_attr += (value * DecisionTreeBuilder._calculate_info_value(class_counts))
 
             attr_gains[attr] = (info_d - info_attr)
 
-        # Return attributes with descending information gain order
         return OrderedDict(sorted(attr_gains.items(), key=lambda d: d[1], reverse=True))
 
     @staticmethod
-    def _get_criteria(train_set, attr_idx):
-        attr_data = [x[attr_idx] for x in train_set]
-
-        criteria_c = Counter(attr_data)
-        return criteria_c.keys()
-
-    @staticmethod
-    def _select_attribute(train_set, attributes):
-        info_d = DecisionTreeBuilder._get_info_d_value(train_set)
+    def _select_attribute(data_set, rows, attributes, attr_indices, class_counts):
+        info_d = DecisionTreeBuilder._get_info_d_value(class_counts)
         # Ignore class attr
-        attr_gains = DecisionTreeBuilder._calculate_information_gains(train_set, attributes[:-1], info_d)
+        attr_gains = DecisionTreeBuilder._calculate_information_gains(
+            data_set, rows, attributes[:-1], attr_indices[:-1], info_d
+        )
 
         return list(attr_gains.items())[0]
 
     @staticmethod
-    def _split_by_criteria(train_set, attr_idx, criteria):
-        split_data = []
-        for x in train_set:
-            if x[attr_idx] == criteria:
-                new_data = x[:attr_idx] + x[attr_idx+1:]
-                split_data.append(new_data)
+    def _split_by_criteria(data_set, rows, attr_idx):
+        """Return (value, rows having the value) by order of first appearance of the values"""
+        codes = data_set.codes[attr_idx, rows]
+        # Rows of each value keep their order
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        sorted_rows = rows[order]
+        starts = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+
+        bounds = [0] + starts.tolist() + [len(rows)]
+        # First position of a value is the position of its first row in the order
+        first_positions = order[bounds[:-1]].tolist()
+        value_codes = sorted_codes[bounds[:-1]].tolist()
+        splits = sorted(zip(first_positions, value_codes, bounds[:-1], bounds[1:]))
+
+        return [(data_set.values[attr_idx][code], sorted_rows[start:end]) for _, code, start, end in splits]
+
+    @staticmethod
+    def _get_majority_class(data_set, class_counts):
+        # The first of the most common classes in sorted order
+        return data_set.values[-1][int(np.argmax(class_counts))]
 
-        return split_data
+    @staticmethod
+    def _build_tree(train_set, attributes, workers=1, parallel_rows=1000):
+        data_set = EncodedDataSet(train_set, len(attributes))
+        rows = np.arange(len(train_set))
+        attr_indices = list(range(len(attributes)))
+        if workers <= 1:
+            return DecisionTreeBuilder._build_subtree(data_set, rows, attributes, attr_indices)
+
+        with _create_worker_pool(data_set, workers) as pool:
+            return DecisionTreeBuilder._build_tree_in_pool(
+                data_set, rows, attributes, attr_indices, pool, parallel_rows
+            )
 
     @staticmethod
-    def _get_majority_class(train_set):
-        train_set_to_check = [x[-1] for x in train_set]
-        train_set_to_check.sort()
+    def _build_tree_in_pool(data_set, rows, attributes, attr_indices, pool, parallel_rows):
+        """Build a tree by the workers of pool
+
+        The attribute of each node of at least parallel_rows rows is selected by a worker and its children are
+        queued, so large subtrees at any depth are shared by the workers. Smaller sibling subtrees are built
+        whole by a worker, in batches of about parallel_rows rows.
+        """
+        finished = queue.Queue()
+
+        def put_task(function, criteria_nodes, rows_list, attributes, attr_indices):
+            # Only row indices are sent, workers have the data set already
+            pool.apply_async(
+                function, (rows_list, attributes, attr_indices),
+                callback=lambda nodes: finished.put((criteria_nodes, rows_list, attributes, attr_indices, nodes)),
+                error_callback=lambda error: finished.put((None, None, None, None, error))
+            )
+
+        def put_children(splits, criteria_nodes, attributes, attr_indices):
+            """Queue tasks building the children and return the number of tasks"""
+            tasks = 0
+            batch = []
+            batch_rows = 0
+            for criteria_node, (criteria, split_rows) in zip(criteria_nodes, splits):
+                if len(split_rows) >= parallel_rows:
+                    put_task(_select_worker_nodes, [criteria_node], [split_rows], attributes, attr_indices)
+                    tasks += 1
+                    continue
 
-        c = Counter(train_set_to_check)
-        return c.most_common(1)[0][0]
+                batch.append((criteria_node, split_rows))
+                batch_rows += len(split_rows)
+                if batch_rows >= parallel_rows:
+                    put_task(_build_worker_subtrees, *zip(*batch), attributes, attr_indices)
+                    tasks += 1
+                    batch = []
+                    batch_rows = 0
+            if batch:
+                put_task(_build_worker_subtrees, *zip(*batch), attributes, attr_indices)
+                tasks += 1
+            return tasks
+
+        # Placeholder parent of the root
+        root = CriteriaNode(None, len(rows))
+        pending = put_children([(None, rows)], [root], attributes, attr_indices)
+        while pending:
+            criteria_nodes, rows_list, attributes, attr_indices, nodes = finished.get()
+            pending -= 1
+            if criteria_nodes is None:
+                raise nodes
+
+            for criteria_node, rows, node in zip(criteria_nodes, rows_list, nodes):
+                if not isinstance(node, Node):
+                    # Rows are split here, which is cheap, so they are sent to the workers only once
+                    reduced_attributes, reduced_attr_indices, splits = DecisionTreeBuilder._split_node(
+                        data_set, rows, attributes, attr_indices, node
+                    )
+                    node = AttributeNode(node)
+                    node.criteria.extend(CriteriaNode(criteria, len(x)) for criteria, x in splits)
+                    pending += put_children(splits, node.criteria, reduced_attributes, reduced_attr_indices)
+
+                DecisionTreeBuilder._set_child(criteria_node, node)
+
+        return root.attribute_node or root.class_node
 
     @staticmethod
-    def _build_tree(train_set, attributes):
-        class_data = [x[-1] for x in train_set]
+    def _select_node(data_set, rows, attributes, attr_indices):
+        """Return a class node of given rows of data_set if they are a leaf, otherwise the attribute to split by"""
+        class_counts = DecisionTreeBuilder._get_class_counts(data_set, rows)
         # If all class label in train set is same
-        if len(set(class_data)) == 1:
+        if np.count_nonzero(class_counts) == 1:
             # Return class label
-            return ClassNode(class_data[-1])
+            return ClassNode(data_set.values[-1][int(np.argmax(class_counts))])
 
         # If there's no attribute to examine
         if len(attributes) < 3:
             # Return class label majority in train_set
-            major_class = DecisionTreeBuilder._get_majority_class(train_set)
+            major_class = DecisionTreeBuilder._get_majority_class(data_set, class_counts)
             return ClassNode(major_class)
 
-        selected_attribute, info_gain = DecisionTreeBuilder._select_attribute(train_set, attributes)
+        selected_attribute, info_gain = DecisionTreeBuilder._select_attribute(
+            data_set, rows, attributes, attr_indices, class_counts
+        )
+        return selected_attribute
 
+    @staticmethod
+    def _split_node(data_set, rows, attributes, attr_indices, selected_attribute):
+        """Return remaining attributes, their data_set columns and [(criteria, rows)] of selected_attribute"""
         attr_idx = attributes.index(selected_attribute)
         reduced_attributes = attributes[:]
         reduced_attributes.remove(selected_attribute)
+        reduced_attr_indices = attr_indices[:attr_idx] + attr_indices[attr_idx + 1:]
 
-        attribute_node = AttributeNode(selected_attribute)
-        for criteria in DecisionTreeBuilder._get_criteria(train_set, attr_idx):
-            split_train_set = DecisionTreeBuilder._split_by_criteria(train_set, attr_idx, criteria)
+        splits = DecisionTreeBuilder._split_by_criteria(data_set, rows, attr_indices[attr_idx])
+        return reduced_attributes, reduced_attr_indices, splits
 
-            criteria_node = CriteriaNode(criteria, len(split_train_set))
+    @staticmethod
+    def _build_subtree(data_set, rows, attributes, attr_indices):
+        """Build a tree of given rows of data_set, attr_indices are data_set columns of attributes"""
+        selected_attribute = DecisionTreeBuilder._select_node(data_set, rows, attributes, attr_indices)
+        if isinstance(selected_attribute, ClassNode):
+            return selected_attribute
+
+        reduced_attributes, reduced_attr_indices, splits = DecisionTreeBuilder._split_node(
+            data_set, rows, attributes, attr_indices, selected_attribute
+        )
+        attribute_node = AttributeNode(selected_attribute)
+        for criteria, split_rows in splits:
+            criteria_node = CriteriaNode(criteria, len(split_rows))
             attribute_node.criteria.append(criteria_node)
-            if len(split_train_set) > 0:
-                node = DecisionTreeBuilder._build_tree(split_train_set, reduced_attributes)
-                if node is not None:
-                    if isinstance(node, AttributeNode):
-                        criteria_node.attribute_node = node
-                    elif isinstance(node, ClassNode):
-                        criteria_node.class_node = node
-            else:
-                # Choose major class label from the parent's train set if split train set is empty
-                major_class = DecisionTreeBuilder._get_majority_class(train_set)
-                criteria_node.class_node = ClassNode(major_class)
+            DecisionTreeBuilder._set_child(criteria_node, DecisionTreeBuilder._build_subtree(
+                data_set, split_rows, reduced_attributes, reduced_attr_indices
+            ))
 
         # Return root node
         return attribute_node
 
     @staticmethod
-    def _get_class_using_tree(node, data_row, attributes):
-        if isinstance(node, ClassNode):
-            return node.value
+    def _set_child(criteria_node, node):
+        if isinstance(node, AttributeNode):
+            criteria_node.attribute_node = node
+        elif isinstance(node, ClassNode):
+            criteria_node.class_node = node
+
+    def classify(self, tree, batch_size=1 << 16):
+        """Classify the test set with a tree of nodes or a compiled tree"""
+        if not isinstance(tree, CompiledTree):
+            tree = CompiledTree.from_tree(tree, self.initial_attributes[:-1])
+
+        # Each batch is written as soon as it is classified
+        with open(self.output_filename, 'w') as f2, open(self.test_set_filename, 'r') as f:
+            header = f.readline()
+            attributes = header.strip().split('\t') if header else []
+            f2.write('\t'.join(attributes) + '\tClass' + '\n')
+
+            while True:
+                lines = [line.strip() for line in itertools.islice(f, batch_size)]
+                if not lines:
+                    break
+
+                rows = [line.split('\t') for line in lines]
+                class_results, replaced = tree.classify(rows, attributes)
+                # Lines are written as they are unless a value is replaced
+                for idx in replaced:
+                    lines[idx] = '\t'.join(rows[idx])
+                f2.writelines(map('{}\t{}\n'.format, lines, class_results))
 
-        if isinstance(node, CriteriaNode):
-            return node.class_node.value
+    def run(self):
+        if self.train_set_filename is None:
+            decision_tree = CompiledTree.load(self.model_filename)
+        else:
+            decision_tree = CompiledTree.from_tree(
+                self._build_tree(
+                    self.initial_train_set, self.initial_attributes, self._workers, self._parallel_rows
+                ),
+                self.initial_attributes[:-1]
+            )
+            if self.model_filename is not None:
+                decision_tree.save(self.model_filename)
 
-        if isinstance(node, AttributeNode):
-            attr_idx = attributes.index(node.name)
-            max_count = 0
-            max_count_criteria_name = None
-            for criteria in node.criteria:
-                if criteria.data_count > max_count:
-                    max_count = criteria.data_count
-                    max_count_criteria_name = criteria.name
-
-                if data_row[attr_idx] == criteria.name:
-                    if criteria.class_node is not None:
-                        return DecisionTreeBuilder._get_class_using_tree(
-                            criteria.class_node,
-                            data_row,
-                            attributes
-                        )
-                    elif criteria.attribute_node is not None:
-                        return DecisionTreeBuilder._get_class_using_tree(
-                            criteria.attribute_node,
-                            data_row,
-                            attributes
-                        )
-
-            # Choose the criteria name from bigger train set if there's no matching criteria
-            if max_count_criteria_name is not None:
-                data_row[attr_idx] = max_count_criteria_name
-
-            return DecisionTreeBuilder._get_class_using_tree(node, data_row, attributes)
-
-    def classify(self, tree):
-        result = attributes = []
-        with open(self.test_set_filename, 'r') as f:
-            for idx, line in enumerate(f):
-                data = line.strip().split('\t')
-                if idx == 0:
-                    attributes = data
-                    continue
+        if self.test_set_filename is not None:
+            self.classify(decision_tree)
 
-                class_result = DecisionTreeBuilder._get_class_using_tree(tree, data, attributes)
-                data.append(class_result)
 
-                result.append('\t'.join(data))
+# Encoded train set of subtree worker processes, forked workers inherit it from the parent
+_worker_data_set = None
 
-        with open(self.output_filename, 'w') as f:
-            f.write('\t'.join(attributes) + '\tClass' + '\n')
-            for line in result:
-                f.write(line + '\n')
 
-    def run(self):
-        decision_tree = self._build_tree(self.initial_train_set, self.initial_attributes)
-        self.classify(decision_tree)
+def _init_worker(data_set):
+    global _worker_data_set
+    _worker_data_set = data_set
+
+
+def _create_worker_pool(data_set, workers):
+    global _worker_data_set
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _worker_data_set = data_set
+        return multiprocessing.get_context('fork').Pool(workers)
+
+    # No fork (e.g. Windows), send the data set once per worker instead
+    return multiprocessing.Pool(workers, initializer=_init_worker, initargs=(data_set,))
+
+
+def _build_worker_subtrees(rows_list, attributes, attr_indices):
+    return [DecisionTreeBuilder._build_subtree(_worker_data_set, x, attributes, attr_indices) for x in rows_list]
+
+
+def _select_worker_nodes(rows_list, attributes, attr_indices):
+    return [DecisionTreeBuilder._select_node(_worker_data_set, x, attributes, attr_indices) for x in rows_list]
 
 
 if __name__ == '__main__':
-    _, train_set_filename, test_set_filename, output_filename = sys.argv
-    builder = DecisionTreeBuilder(train_set_filename, test_set_filename, output_filename)
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s train_set test_set output\n'
+              '       %(prog)s --save-model MODEL train_set [test_set output]\n'
+              '       %(prog)s --load-model MODEL test_set output'
+    )
+    parser.add_argument('filenames', nargs='+', metavar='filename')
+    model_group = parser.add_mutually_exclusive_group()
+    model_group.add_argument('--save-model', default=None, metavar='MODEL',
+                             help='train and save the tree into MODEL, classifying is optional')
+    model_group.add_argument('--load-model', default=None, metavar='MODEL',
+                             help='classify with the tree saved in MODEL instead of training')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of processes to build the tree with (default: 1)')
+    parser.add_argument('--parallel-rows', type=int, default=1000,
+                        help='min train rows of a node to split it alone in a worker process, '
+                             'smaller subtrees are built whole (default: 1000)')
+    args = parser.parse_args()
+
+    if args.load_model is not None:
+        if len(args.filenames) != 2:
+            parser.error('test set and output filenames are required with --load-model')
+        builder = DecisionTreeBuilder(None, args.filenames[0], args.filenames[1], args.load_model)
+    else:
+        if len(args.filenames) not in ((1, 3) if args.save_model is not None else (3,)):
+            parser.error('train set, test set and output filenames are required')
+        train_set_filename, test_set_filename, output_filename = (args.filenames + [None, None])[:3]
+        builder = DecisionTreeBuilder(
+            train_set_filename, test_set_filename, output_filename, args.save_model, args.workers, args.parallel_rows
+        )
+
     builder.run()
@@ -2,107 +2,427 @@
 from __future__ import division
 from __future__ import print_function
 
-import math
-import operator
-import sys
-from collections import defaultdict, OrderedDict
+import argparse
+import hashlib
+import multiprocessing
+import os
 
+import numpy as np
+from scipy import sparse
 
-class Rating(object):
-    def __init__(self, user_id, item_id, rating, timestamp):
-        self.user_id = int(user_id)
-        self.item_id = int(item_id)
-        self.rating = int(rating)
-        self.timestamp = timestamp
+# Version of the cached model format, bump on incompatible changes so that older caches are rebuilt
+CACHE_VERSION = 2
+MODEL_KEYS = {'version', 'user_ids', 'item_ids', 'item', 'rating', 'timestamp', 'user_indptr'}
+# Batch predictions this close to a rounding boundary are predicted one by one
+BATCH_TOLERANCE = 1e-6
 
-    def __repr__(self):
-        return '{} {} {} {}'.format(self.user_id, self.item_id, self.rating, self.timestamp)
+
+def _index_by_first_appearance(ids):
+    """Return distinct ids by order of first appearance and dense index of each given id"""
+    distinct_ids, first_positions, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    order = np.argsort(first_positions, kind='stable')
+    dense_index = np.empty_like(order)
+    dense_index[order] = np.arange(len(order))
+
+    return distinct_ids[order], dense_index[inverse.ravel()]
+
+
+class RatingStore(object):
+    """Columnar ratings grouped by user (CSR style) with an item permutation for by-item access (CSC style)"""
+
+    def __init__(self, user_ids, item_ids, item, rating, timestamp, user_indptr):
+        # Original ids by dense index, in order of first appearance in the train file
+        self.user_ids = user_ids.astype(np.int32)
+        self.item_ids = item_ids.astype(np.int32)
+        # Per rating columns, ratings of user u are [user_indptr[u], user_indptr[u + 1])
+        self.item = item.astype(np.int32)
+        self.rating = rating.astype(np.int8)
+        self.timestamp = timestamp.astype(np.int64)
+        self.user_indptr = user_indptr.astype(np.int64)
+        # Ratings of item i are item_order[item_indptr[i]:item_indptr[i + 1]]
+        self.item_order = np.argsort(self.item, kind='stable').astype(np.int32)
+        self.item_indptr = np.zeros(len(self.item_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.item, minlength=len(self.item_ids)), out=self.item_indptr[1:])
+
+    @classmethod
+    def from_columns(cls, user, item, rating, timestamp):
+        """Build a store from original id columns, a later rating of the same user/item pair wins"""
+        user_ids, user = _index_by_first_appearance(user)
+        item_ids, item = _index_by_first_appearance(item)
+
+        return cls._from_dense_columns(user_ids, item_ids, user, item, rating, timestamp)
+
+    @classmethod
+    def _from_dense_columns(cls, user_ids, item_ids, user, item, rating, timestamp):
+        key = user.astype(np.int64) * len(item_ids) + item
+        order = np.argsort(key, kind='stable')
+        sorted_key = key[order]
+        is_last = np.ones(len(order), dtype=bool)
+        is_last[:-1] = sorted_key[:-1] != sorted_key[1:]
+        order = order[is_last]
+
+        user_indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(user[order], minlength=len(user_ids)), out=user_indptr[1:])
+
+        return cls(user_ids, item_ids, item[order], rating[order], timestamp[order], user_indptr)
+
+    def add(self, user, item, rating, timestamp):
+        """Return a new store with given original id columns appended, as if they were at the end of the file"""
+        # Known ids come first so that they keep their dense index
+        user_ids, all_user = _index_by_first_appearance(np.concatenate([self.user_ids, user]))
+        item_ids, all_item = _index_by_first_appearance(np.concatenate([self.item_ids, item]))
+
+        existing_user = self.get_users_of_ratings(np.arange(len(self)))
+        return self._from_dense_columns(
+            user_ids,
+            item_ids,
+            np.concatenate([existing_user, all_user[len(self.user_ids):]]),
+            np.concatenate([self.item, all_item[len(self.item_ids):]]),
+            np.concatenate([self.rating, rating]),
+            np.concatenate([self.timestamp, timestamp])
+        )
+
+    def __len__(self):
+        return len(self.item)
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in (self.user_ids, self.item_ids, self.item, self.rating, self.timestamp,
+                                      self.user_indptr, self.item_order, self.item_indptr))
+
+    def get_users_of_ratings(self, positions):
+        """Return dense user index of ratings at given positions"""
+        return self.user_indptr.searchsorted(positions, side='right') - 1
+
+    def get_item_ratings(self, item_idx):
+        """Return dense user indices and ratings of given item"""
+        positions = self.item_order[self.item_indptr[item_idx]:self.item_indptr[item_idx + 1]]
+        return self.get_users_of_ratings(positions), self.rating[positions]
+
+    def to_csr(self):
+        shape = (len(self.user_ids), len(self.item_ids))
+        return sparse.csr_matrix((self.rating.astype(np.int64), self.item, self.user_indptr), shape=shape)
 
 
 class Recommender(object):
-    def __init__(self, train_data_filename, test_data_filename):
+    def __init__(self, train_data_filename, test_data_filename, neighbor_count=None, cache_dir=None,
+                 workers=1, mode='user'):
         self._train_data_filename = train_data_filename
         self._test_data_filename = test_data_filename
-        self.users = defaultdict(dict)
-        self.items = defaultdict(dict)
-        self.user_similarity = defaultdict(dict)
+        # 'user': user-based PCC, 'item': item-based adjusted cosine
+        self._mode = mode
+        # Use top-k similar users (items) only, None means all of non-negative similar users (items)
+        self._neighbor_count = neighbor_count
+        # Directory to keep computed models keyed by train file fingerprint, None means no caching
+        self._cache_dir = cache_dir
+        # Number of processes to predict test data with
+        self._workers = workers
+        self.ratings = None
+        self.user_ids = []
+        self.item_ids = []
+        self.user_index = {}
+        self.item_index = {}
+        # user x user similarity scores (NaN if no common items)
+        self.user_similarity = None
+        # Pair sums of _calculate_user_pair_statistics, kept from the first add_ratings() on to update from
+        self._user_pair_statistics = None
+        # item x item similarity scores (NaN if no common raters)
+        self.item_similarity = None
+        # Similar users (items) of each user (item) by dense index, CSR style: neighbors of k are
+        # _neighbor_indices[_neighbor_indptr[k]:_neighbor_indptr[k + 1]] by ascending index, with their scores
+        self._neighbor_indptr = np.zeros(1, dtype=np.int64)
+        self._neighbor_indices = np.zeros(0, dtype=np.int32)
+        self._neighbor_scores = np.zeros(0)
+        # Float user x item ratings and rated mask for batch prediction
+        self._rating_matrix = None
+        self._rated_matrix = None
 
     def _load_ratings(self):
         print("Loading: " + self._train_data_filename)
-        with open(self._train_data_filename, 'r') as f:
-            for idx, line in enumerate(f):
-                # data format [user_id]\t[item_id]\t[rating]\t[time_stamp]\n
-                data = line.strip().split('\t')
-                r = Rating(data[0], data[1], data[2], data[3])
-                self.users[data[0]][data[1]] = r
-                self.items[data[1]][data[0]] = r
-
-    def _get_common_item_ids_by_user_ids(self, user_id, opponent_user_id):
-        """Returns common item ids between two users"""
-        return self.users[user_id].keys() & self.users[opponent_user_id].keys()
-
-    def _calculate_user_similarity(self):
+        # data format [user_id]\t[item_id]\t[rating]\t[time_stamp]\n
+        data = np.loadtxt(self._train_data_filename, dtype=np.int64, ndmin=2).reshape(-1, 4)
+        self._set_ratings(RatingStore.from_columns(data[:, 0], data[:, 1], data[:, 2], data[:, 3]))
+
+    def _set_ratings(self, ratings):
+        self.ratings = ratings
+        self.user_ids = ratings.user_ids.tolist()
+        self.item_ids = ratings.item_ids.tolist()
+        self.user_index = {user_id: idx for idx, user_id in enumerate(self.user_ids)}
+        self.item_index = {item_id: idx for idx, item_id in enumerate(self.item_ids)}
+
+    def _calculate_user_pair_statistics(self, user_indices=None):
+        """Return sums over co-rated items of (given users, all users) pairs.
+
+        Each of them is an exact integer matrix, row = user, column = opponent user:
+        co-rated item count, user rating sum, opponent rating sum, user squared rating sum,
+        opponent squared rating sum and the sum of rating products.
+        """
+        ratings = self.ratings.to_csr()
+        ratings_sq = ratings.multiply(ratings).tocsr()
+        mask = ratings.copy()
+        mask.data = np.ones_like(mask.data)
+
+        if user_indices is None:
+            common_items_count = mask.dot(mask.T).toarray()
+            user_r_sum = ratings.dot(mask.T).toarray()
+            user_r_sq_sum = ratings_sq.dot(mask.T).toarray()
+            multiple_sum = ratings.dot(ratings.T).toarray()
+            return (common_items_count, user_r_sum, user_r_sum.T, user_r_sq_sum, user_r_sq_sum.T,
+                    multiple_sum)
+
+        user_ratings = ratings[user_indices]
+        user_ratings_sq = ratings_sq[user_indices]
+        user_mask = mask[user_indices]
+        return (
+            user_mask.dot(mask.T).toarray(),
+            user_ratings.dot(mask.T).toarray(),
+            user_mask.dot(ratings.T).toarray(),
+            user_ratings_sq.dot(mask.T).toarray(),
+            user_mask.dot(ratings_sq.T).toarray(),
+            user_ratings.dot(ratings.T).toarray()
+        )
+
+    @staticmethod
+    def _calculate_pcc(user_pair_statistics, user_indices):
+        """Return similarity scores for given pair statistics whose rows are given users"""
+        (common_items_count, user_r_sum, opponent_user_r_sum, user_r_sq_sum, opponent_user_r_sq_sum,
+         multiple_sum) = user_pair_statistics
+
+        # Calculate similarity score by using Pearson Correlation Coefficient(PCC)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            upper_result = multiple_sum - (user_r_sum * opponent_user_r_sum / common_items_count)
+
+            u_sq = user_r_sq_sum - user_r_sum ** 2 / common_items_count
+            o_u_sq = opponent_user_r_sq_sum - opponent_user_r_sum ** 2 / common_items_count
+            lower_result = np.sqrt(u_sq * o_u_sq)
+
+            similarity_scores = upper_result / lower_result
+
+        has_common_items = common_items_count > 0
+        has_common_items[np.arange(len(user_indices)), user_indices] = False
+        similarity_scores[(lower_result == 0) | (upper_result == 0)] = 0
+        similarity_scores[~has_common_items] = np.nan
+
+        return similarity_scores
+
+    def _calculate_user_similarity(self, keep_statistics=False):
         print("Calculating user similarity scores...")
-        for user_id, _ in self.users.items():
-            for opponent_user_id, _ in self.users.items():
-                if user_id == opponent_user_id:
-                    continue
+        statistics = self._calculate_user_pair_statistics()
+        if keep_statistics:
+            self._user_pair_statistics = statistics
+        self.user_similarity = self._calculate_pcc(statistics, np.arange(len(self.user_ids)))
 
-                if self.user_similarity[opponent_user_id].get(user_id):
-                    self.user_similarity[user_id][opponent_user_id] = self.user_similarity[opponent_user_id][user_id]
-                    continue
+    def _update_user_similarity(self, user_indices):
+        """Refresh pair statistics and similarity scores of given users only"""
+        user_count = len(self.user_ids)
+        old_user_count = len(self.user_similarity)
+        if old_user_count < user_count:
+            # Make room for new users
+            padding = ((0, user_count - old_user_count), (0, user_count - old_user_count))
+            self._user_pair_statistics = tuple(np.pad(x, padding) for x in self._user_pair_statistics)
+            self.user_similarity = np.pad(self.user_similarity, padding, constant_values=np.nan)
 
-                common_item_ids = self._get_common_item_ids_by_user_ids(user_id, opponent_user_id)
-                common_items_count = len(common_item_ids)
-                if common_items_count == 0:
-                    continue
+        (common_items_count, user_r_sum, _, user_r_sq_sum, _,
+         multiple_sum) = self._user_pair_statistics
+        statistics = self._calculate_user_pair_statistics(user_indices)
+        (user_common_items_count, user_user_r_sum, user_opponent_user_r_sum, user_user_r_sq_sum,
+         user_opponent_user_r_sq_sum, user_multiple_sum) = statistics
 
-                # Calculate similarity score by using Pearson Correlation Coefficient(PCC)
-                user_r_sum = opponent_user_r_sum = 0
-                user_r_sq_sum = opponent_user_r_sq_sum = 0
-                multiple_sum = 0
+        # Fill both the rows and the columns of given users
+        common_items_count[user_indices] = user_common_items_count
+        common_items_count[:, user_indices] = user_common_items_count.T
+        user_r_sum[user_indices] = user_user_r_sum
+        user_r_sum[:, user_indices] = user_opponent_user_r_sum.T
+        user_r_sq_sum[user_indices] = user_user_r_sq_sum
+        user_r_sq_sum[:, user_indices] = user_opponent_user_r_sq_sum.T
+        multiple_sum[user_indices] = user_multiple_sum
+        multiple_sum[:, user_indices] = user_multiple_sum.T
+        self._user_pair_statistics = (common_items_count, user_r_sum, user_r_sum.T, user_r_sq_sum,
+                                      user_r_sq_sum.T, multiple_sum)
 
-                for item_id in common_item_ids:
-                    user_rating = self.users[user_id][item_id].rating
-                    opponent_user_rating = self.users[opponent_user_id][item_id].rating
+        similarity_scores = self._calculate_pcc(statistics, user_indices)
+        self.user_similarity[user_indices] = similarity_scores
+        self.user_similarity[:, user_indices] = similarity_scores.T
 
-                    user_r_sum += user_rating
-                    opponent_user_r_sum += opponent_user_rating
+    def _calculate_item_similarity(self):
+        print("Calculating item similarity scores...")
+        ratings = self.ratings.to_csr().astype(np.float64)
+        mask = ratings.copy()
+        mask.data = np.ones_like(mask.data)
 
-                    user_r_sq_sum += user_rating ** 2
-                    opponent_user_r_sq_sum += opponent_user_rating ** 2
+        # Subtract each user's average rating from the user's ratings
+        user_rating_counts = np.diff(ratings.indptr)
+        user_avgs = np.asarray(ratings.sum(axis=1)).ravel() / np.maximum(user_rating_counts, 1)
+        adjusted = ratings.copy()
+        adjusted.data -= np.repeat(user_avgs, user_rating_counts)
+        adjusted_sq = adjusted.multiply(adjusted).tocsr()
 
-                    multiple_sum += (user_rating * opponent_user_rating)
+        # Sums over common raters, row = item, column = opponent item
+        common_raters_count = mask.T.dot(mask).toarray()
+        multiple_sum = adjusted.T.dot(adjusted).toarray()
+        item_sq_sum = adjusted_sq.T.dot(mask).toarray()
 
-                upper_result = multiple_sum - (user_r_sum * opponent_user_r_sum / common_items_count)
+        # Calculate similarity score by using adjusted cosine similarity
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower_result = np.sqrt(item_sq_sum * item_sq_sum.T)
+            similarity_scores = multiple_sum / lower_result
 
-                u_sq = user_r_sq_sum - pow(user_r_sum, 2) / common_items_count
-                o_u_sq = opponent_user_r_sq_sum - pow(opponent_user_r_sum, 2) / common_items_count
-                lower_result = math.sqrt(u_sq * o_u_sq)
+        has_common_raters = common_raters_count > 0
+        np.fill_diagonal(has_common_raters, False)
+        similarity_scores[lower_result == 0] = 0
+        similarity_scores[~has_common_raters] = np.nan
+        self.item_similarity = similarity_scores
 
-                if lower_result == 0 or upper_result == 0:
-                    similarity_score = 0
-                else:
-                    similarity_score = upper_result / lower_result
+    def _calculate_similarity(self):
+        if self._mode == 'item':
+            self._calculate_item_similarity()
+        else:
+            self._calculate_user_similarity()
 
-                self.user_similarity[user_id][opponent_user_id] = similarity_score
+    def _get_similarity(self):
+        return self.item_similarity if self._mode == 'item' else self.user_similarity
 
-    def _predict_rating(self, user_id, item_id):
-        similiar_user_objects = self.user_similarity[user_id].items()
-        # Order by similarity score (descending order)
-        similiar_user_objects = OrderedDict(sorted(similiar_user_objects, key=operator.itemgetter(1), reverse=True))
+    def _get_fingerprint(self):
+        """Return content hash of the train file"""
+        h = hashlib.sha1()
+        with open(self._train_data_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
 
-        upper_result = lower_result = 0
-        for similiar_user_id, similiarity_score in similiar_user_objects.items():
-            if similiarity_score < 0:
-                continue
+        return h.hexdigest()
+
+    def _get_cache_filenames(self):
+        prefix = os.path.join(self._cache_dir, '{}.v{}'.format(self._get_fingerprint(), CACHE_VERSION))
+        return prefix + '.npz', prefix + '.{}_similarity.npy'.format(self._mode)
+
+    def _save_model(self):
+        """Save similarity scores, user/item indices and ratings into the cache"""
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+        model_filename, similarity_filename = self._get_cache_filenames()
+        print("Saving model: " + model_filename)
+
+        # Write into temporary files first so that a broken run never leaves a half-written cache
+        with open(similarity_filename + '.tmp', 'wb') as f:
+            np.save(f, self._get_similarity())
+        with open(model_filename + '.tmp', 'wb') as f:
+            np.savez(
+                f,
+                version=np.array(CACHE_VERSION),
+                user_ids=self.ratings.user_ids,
+                item_ids=self.ratings.item_ids,
+                item=self.ratings.item,
+                rating=self.ratings.rating,
+                timestamp=self.ratings.timestamp,
+                user_indptr=self.ratings.user_indptr
+            )
+
+        os.rename(similarity_filename + '.tmp', similarity_filename)
+        os.rename(model_filename + '.tmp', model_filename)
 
-            similiar_user_item_ids = self.users[similiar_user_id].keys()
-            if item_id in similiar_user_item_ids:
-                similiar_rating = self.users[similiar_user_id][item_id].rating
+    def _load_model(self):
+        """Load a cached model of the train file, return False if there is none"""
+        model_filename, similarity_filename = self._get_cache_filenames()
+        if not (os.path.exists(model_filename) and os.path.exists(similarity_filename)):
+            return False
+
+        print("Loading model: " + model_filename)
+        with np.load(model_filename) as model:
+            # Written in another format (e.g. an older cache copied over), build it again instead
+            if not MODEL_KEYS.issubset(model.files) or int(model['version']) != CACHE_VERSION:
+                print("Outdated model, rebuilding: " + model_filename)
+                return False
+
+            self._set_ratings(RatingStore(
+                model['user_ids'], model['item_ids'], model['item'], model['rating'], model['timestamp'],
+                model['user_indptr']
+            ))
+        similarity_scores = np.load(similarity_filename, mmap_mode='r')
+        if self._mode == 'item':
+            self.item_similarity = similarity_scores
+        else:
+            self.user_similarity = similarity_scores
+
+        return True
+
+    def _index_neighbors(self, similarity):
+        indptr = [0]
+        indices = []
+        scores = []
+        for idx in range(len(similarity)):
+            similarity_scores = similarity[idx]
+            # NaN (nothing in common) is dropped too
+            opponent_indices = np.flatnonzero(similarity_scores >= 0)
+            if self._neighbor_count is not None:
+                # Order by similarity score (descending order) to keep the top ones
+                order = np.argsort(-similarity_scores[opponent_indices], kind='stable')
+                opponent_indices = np.sort(opponent_indices[order][:self._neighbor_count])
+
+            indices.append(opponent_indices.astype(np.int32))
+            scores.append(similarity_scores[opponent_indices].astype(np.float64))
+            indptr.append(indptr[-1] + len(opponent_indices))
+
+        self._neighbor_indptr = np.array(indptr, dtype=np.int64)
+        self._neighbor_indices = np.concatenate(indices + [np.zeros(0, dtype=np.int32)])
+        self._neighbor_scores = np.concatenate(scores + [np.zeros(0)])
+
+    def _build_neighbor_index(self):
+        """Index similar users (items) of each user (item) once, ratings to predict from are read from the store"""
+        print("Building neighbor index...")
+        self._rating_matrix = self.ratings.to_csr().astype(np.float64)
+        self._rated_matrix = self._rating_matrix.copy()
+        self._rated_matrix.data = np.ones_like(self._rated_matrix.data)
+
+        self._index_neighbors(self._get_similarity())
+
+    def _get_similiar_raters(self, key_idx, raters, ratings):
+        """Return similarity scores and ratings of neighbors of key_idx in raters (by ascending index),
+        in neighbor order: by similarity score (descending order), then by index
+        """
+        start, end = self._neighbor_indptr[key_idx], self._neighbor_indptr[key_idx + 1]
+        neighbor_indices = self._neighbor_indices[start:end]
+        neighbor_scores = self._neighbor_scores[start:end]
+
+        # Search the smaller side in the other, both are in ascending index order
+        if len(raters) < len(neighbor_indices):
+            positions = neighbor_indices.searchsorted(raters)
+            found = positions < len(neighbor_indices)
+            found[found] = neighbor_indices[positions[found]] == raters[found]
+            scores = neighbor_scores[positions[found]]
+            ratings = ratings[found]
+        else:
+            positions = raters.searchsorted(neighbor_indices)
+            found = positions < len(raters)
+            found[found] = raters[positions[found]] == neighbor_indices[found]
+            scores = neighbor_scores[found]
+            ratings = ratings[positions[found]]
 
-                upper_result += (similiar_rating * similiarity_score)
-                lower_result += similiarity_score
+        order = (-scores).argsort(kind='stable')
+        return scores[order], ratings[order]
+
+    def _predict_rating(self, user_id, item_id):
+        user_idx = self.user_index.get(user_id)
+        item_idx = self.item_index.get(item_id)
+        if user_idx is None or item_idx is None:
+            # Nothing to predict from
+            return 3
+
+        if self._mode == 'item':
+            # Similar items which the user rated
+            start, end = self.ratings.user_indptr[user_idx], self.ratings.user_indptr[user_idx + 1]
+            key_idx, raters, ratings = item_idx, self.ratings.item[start:end], self.ratings.rating[start:end]
+        else:
+            # Similar users who rated the item
+            raters, ratings = self.ratings.get_item_ratings(item_idx)
+            key_idx = user_idx
+
+        scores, ratings = self._get_similiar_raters(key_idx, raters, ratings)
+        upper_result = lower_result = 0
+        if len(scores):
+            # Summed one by one in neighbor order (cumsum doesn't pair terms up), same as the loop it replaces
+            upper_result = float((ratings * scores).cumsum()[-1])
+            lower_result = float(scores.cumsum()[-1])
 
         if upper_result != 0 and lower_result != 0:
             predicted_rating = round(upper_result / lower_result)
@@ -113,24 +433,227 @@ class Recommender(object):
 
         return predicted_rating
 
+    def get_neighbor_weights(self, key):
+        """Return similarity scores of neighbors of given user (item) id as a dense vector, 0 for the others"""
+        index = self.item_index if self._mode == 'item' else self.user_index
+        weights = np.zeros(len(index))
+        key_idx = index.get(key)
+        if key_idx is not None:
+            start, end = self._neighbor_indptr[key_idx], self._neighbor_indptr[key_idx + 1]
+            weights[self._neighbor_indices[start:end]] = self._neighbor_scores[start:end]
+
+        return weights
+
+    def _get_prediction_sums(self, user_ids, item_ids, get_neighbor_weights):
+        """Return rating x similarity sums and similarity sums of every (user, item) of given ids"""
+        user_indices = [self.user_index.get(x) for x in user_ids]
+        item_indices = [self.item_index.get(x) for x in item_ids]
+        known_user_indices = [x for x in user_indices if x is not None]
+        known_item_indices = [x for x in item_indices if x is not None]
+
+        if self._mode == 'item':
+            # Similar items which the users rated
+            weights = np.array([get_neighbor_weights(x) for x in item_ids]).reshape(-1, len(self.item_ids))
+            weights = weights[[x is not None for x in item_indices]]
+            upper_result = self._rating_matrix[known_user_indices].dot(weights.T)
+            lower_result = self._rated_matrix[known_user_indices].dot(weights.T)
+        else:
+            # Similar users who rated the items
+            weights = np.array([get_neighbor_weights(x) for x in user_ids]).reshape(-1, len(self.user_ids))
+            weights = weights[[x is not None for x in user_indices]]
+            upper_result = self._rating_matrix.T.dot(weights.T).T[:, known_item_indices]
+            lower_result = self._rated_matrix.T.dot(weights.T).T[:, known_item_indices]
+
+        # Unknown users or items have nothing to predict from
+        shape = (len(user_ids), len(item_ids))
+        full_upper_result = np.zeros(shape)
+        full_lower_result = np.zeros(shape)
+        rows = np.array([x is not None for x in user_indices], dtype=bool)
+        cols = np.array([x is not None for x in item_indices], dtype=bool)
+        full_upper_result[np.ix_(rows, cols)] = upper_result
+        full_lower_result[np.ix_(rows, cols)] = lower_result
+
+        return full_upper_result, full_lower_result
+
+    def predict_batch(self, pairs, get_neighbor_weights=None):
+        """Return predicted ratings of (user_id, item_id) pairs with matrix products.
+
+        get_neighbor_weights replaces get_neighbor_weights() e.g. to cache hot users (items).
+        Results are the same as predicting one by one, _predict_rating() writes the prediction file.
+        """
+        if not pairs:
+            return []
+
+        user_ids, item_ids = zip(*pairs)
+        distinct_user_ids = list(set(user_ids))
+        distinct_item_ids = list(set(item_ids))
+        upper_result, lower_result = self._get_prediction_sums(
+            distinct_user_ids,
+            distinct_item_ids,
+            get_neighbor_weights or self.get_neighbor_weights
+        )
+
+        rows = {x: idx for idx, x in enumerate(distinct_user_ids)}
+        cols = {x: idx for idx, x in enumerate(distinct_item_ids)}
+        row_indices = [rows[x] for x in user_ids]
+        col_indices = [cols[x] for x in item_ids]
+        upper_result = upper_result[row_indices, col_indices]
+        lower_result = lower_result[row_indices, col_indices]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = upper_result / lower_result
+            predicted_ratings = np.round(ratios)
+        predicted_ratings[predicted_ratings < 0] = 1
+        predicted_ratings[(upper_result == 0) | (lower_result == 0)] = 3
+        predicted_ratings = predicted_ratings.astype(int).tolist()
+
+        # Sums of matrix products are added in another order than the neighbors, the last bits may differ.
+        # Predict pairs whose rating could come out the other way (near .5 or sums near 0) one by one.
+        with np.errstate(invalid='ignore'):
+            unsure = np.abs(ratios - np.floor(ratios) - 0.5) <= BATCH_TOLERANCE * np.maximum(1, np.abs(ratios))
+        # Sums without any term are exactly 0 either way
+        for result in (upper_result, lower_result):
+            unsure |= (result != 0) & (np.abs(result) < BATCH_TOLERANCE)
+        for idx in np.flatnonzero(unsure).tolist():
+            predicted_ratings[idx] = self._predict_rating(*pairs[idx])
+
+        return predicted_ratings
+
+    def recommend(self, user_id, count, get_neighbor_weights=None):
+        """Return (item_id, predicted score) of top-N items by predicted score which the user didn't rate"""
+        if user_id not in self.user_index:
+            return []
+
+        upper_result, lower_result = self._get_prediction_sums(
+            [user_id],
+            self.item_ids,
+            get_neighbor_weights or self.get_neighbor_weights
+        )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = upper_result[0] / lower_result[0]
+
+        rated = self._rated_matrix[self.user_index[user_id]].toarray()[0] > 0
+        scores[rated | (lower_result[0] == 0)] = -np.inf
+        candidates = np.flatnonzero(scores > -np.inf)
+        top = candidates[np.argsort(-scores[candidates], kind='stable')[:count]]
+
+        return [(self.item_ids[x], float(scores[x])) for x in top]
+
+    def add_ratings(self, ratings):
+        """Add (user_id, item_id, rating, timestamp) ratings into the built model.
+
+        Result is the same as rebuilding with the ratings appended to the train file. User based
+        mode only refreshes the similarity of users who got new ratings, after a first update which
+        recalculates all of it to keep the pair sums it updates from. Item based mode recalculates
+        all of item similarity as every user average change moves the adjusted ratings.
+        """
+        columns = np.array(list(ratings), dtype=np.int64).reshape(-1, 4)
+        if len(columns) == 0:
+            return
+
+        self._set_ratings(self.ratings.add(columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3]))
+
+        if self._mode == 'item':
+            self._calculate_item_similarity()
+        elif self._user_pair_statistics is None:
+            # First update, pair statistics are only kept by models which get updates
+            self._calculate_user_similarity(keep_statistics=True)
+        else:
+            changed_user_ids = np.unique(columns[:, 0])
+            self._update_user_similarity(np.array([self.user_index[x] for x in changed_user_ids.tolist()]))
+
+        self._build_neighbor_index()
+
+    def _predict_lines(self, lines):
+        """Return prediction result lines for given test data lines"""
+        result = []
+        for line in lines:
+            # data format [user_id]\t[item_id]\t[rating]\t[time_stamp]\n
+            data = line.strip().split('\t')
+            predicted_score = self._predict_rating(int(data[0]), int(data[1]))
+
+            result.append('{}\t{}\t{}\n'.format(data[0], data[1], predicted_score))
+
+        return result
+
     def _predict(self):
         print("Predicting...")
         name_obj = self._test_data_filename.split('.')[0]
         with open(self._test_data_filename, 'r') as f, open(name_obj + '.base_prediction.txt', 'w') as f2:
-            for idx, line in enumerate(f):
-                # data format [user_id]\t[item_id]\t[rating]\t[time_stamp]\n
-                data = line.strip().split('\t')
-                predicted_score = self._predict_rating(data[0], data[1])
+            if self._workers <= 1:
+                for line in f:
+                    f2.writelines(self._predict_lines([line]))
+                return
+
+            lines = f.readlines()
+            # A few chunks per worker to even out the load, results come back in input order
+            chunk_size = max(1, -(-len(lines) // (self._workers * 4)))
+            chunks = [lines[x:x + chunk_size] for x in range(0, len(lines), chunk_size)]
+
+            with _create_worker_pool(self, self._workers) as pool:
+                for result in pool.imap(_predict_chunk, chunks):
+                    f2.writelines(result)
 
-                f2.write('{}\t{}\t{}\n'.format(data[0], data[1], predicted_score))
+    def build(self):
+        """Load (or build and cache) the model and make it ready to predict"""
+        if self._cache_dir is None or not self._load_model():
+            self._load_ratings()
+            self._calculate_similarity()
+            if self._cache_dir is not None:
+                self._save_model()
+
+        self._build_neighbor_index()
 
     def run(self):
-        self._load_ratings()
-        self._calculate_user_similarity()
+        self.build()
         self._predict()
 
 
+# Model of prediction worker processes. Forked workers inherit it from the parent
+# as it is, so the similarity structures are never pickled per task.
+_worker_recommender = None
+
+
+def _init_worker(recommender):
+    global _worker_recommender
+    _worker_recommender = recommender
+
+
+def _create_worker_pool(recommender, workers):
+    global _worker_recommender
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _worker_recommender = recommender
+        return multiprocessing.get_context('fork').Pool(workers)
+
+    # No fork (e.g. Windows), send the recommender once per worker instead
+    return multiprocessing.Pool(workers, initializer=_init_worker, initargs=(recommender,))
+
+
+def _predict_chunk(lines):
+    return _worker_recommender._predict_lines(lines)
+
+
 if __name__ == '__main__':
-    _, train_data_filename, test_data_filename = sys.argv
-    recommender = Recommender(train_data_filename, test_data_filename)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('train_data_filename')
+    parser.add_argument('test_data_filename')
+    parser.add_argument('-k', '--neighbors', type=int, default=None,
+                        help='number of most similar users (items) to use (default: all)')
+    parser.add_argument('-m', '--mode', choices=('user', 'item'), default='user',
+                        help='user-based PCC or item-based adjusted cosine similarity (default: user)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of cached models (default: .recommender_cache next to the train file)')
+    parser.add_argument('--no-cache', action='store_true', help='always rebuild the model')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of processes to predict with (default: 1)')
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir
+    if args.no_cache:
+        cache_dir = None
+    elif cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(args.train_data_filename), '.recommender_cache')
+
+    recommender = Recommender(args.train_data_filename, args.test_data_filename, args.neighbors, cache_dir,
+                              args.workers, args.mode)
     recommender.run()
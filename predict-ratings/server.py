@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Online rating prediction server.
+
+Loads a Recommender model once and answers over HTTP on localhost:
+    GET /predict?user=<user_id>&item=<item_id>  -> {"user": .., "item": .., "rating": ..}
+    GET /top?user=<user_id>&n=<count>           -> {"user": .., "items": [[item_id, score], ...]}
+    GET /stats                                  -> request count and p50/p99 latency(ms)
+
+Concurrent /predict requests are coalesced into a single batch prediction.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from recommender import Recommender
+
+
+class LatencyRecorder(object):
+    """Keep latencies of recent requests for percentiles"""
+
+    def __init__(self, size=10000):
+        self._latencies = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, latency):
+        self._latencies.append(latency)
+        self.count += 1
+
+    def percentile(self, p):
+        if not self._latencies:
+            return 0
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+class RecommendationServer(object):
+    def __init__(self, recommender, max_batch_size=64, max_delay=0.002, cache_size=1024):
+        self._recommender = recommender
+        self._max_batch_size = max_batch_size
+        # Seconds to wait for more requests to join a batch
+        self._max_delay = max_delay
+        # Neighbor weights of hot users (items)
+        self._get_neighbor_weights = functools.lru_cache(maxsize=cache_size)(recommender.get_neighbor_weights)
+        self._pending = []
+        self._flush_handle = None
+        self.latencies = LatencyRecorder()
+        self.batch_count = 0
+
+    def predict(self, user_id, item_id):
+        """Return a future of predicted rating which is resolved with the next batch"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_id, item_id, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._max_delay, self._flush)
+
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        self.batch_count += 1
+        try:
+            ratings = self._recommender.predict_batch([(x[0], x[1]) for x in pending], self._get_neighbor_weights)
+        except Exception as e:
+            for _, _, future in pending:
+                future.set_exception(e)
+            return
+
+        for (_, _, future), rating in zip(pending, ratings):
+            future.set_result(rating)
+
+    async def _route(self, path, query):
+        if path == '/predict':
+            user_id = int(query['user'][0])
+            item_id = int(query['item'][0])
+            rating = await self.predict(user_id, item_id)
+            return {'user': user_id, 'item': item_id, 'rating': rating}
+
+        if path == '/top':
+            user_id = int(query['user'][0])
+            count = int(query.get('n', ['10'])[0])
+            items = self._recommender.recommend(user_id, count, self._get_neighbor_weights)
+            return {'user': user_id, 'items': items}
+
+        if path == '/stats':
+            cache_info = self._get_neighbor_weights.cache_info()
+            return {
+                'requests': self.latencies.count,
+                'batches': self.batch_count,
+                'p50_ms': self.latencies.percentile(50) * 1000,
+                'p99_ms': self.latencies.percentile(99) * 1000,
+                'cache_hits': cache_info.hits,
+                'cache_misses': cache_info.misses
+            }
+
+        raise KeyError(path)
+
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests of a connection, keep-alive is supported"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    if header.lower().startswith(b'connection:') and b'close' in header.lower():
+                        keep_alive = False
+
+                start = time.perf_counter()
+                try:
+                    _, target, _ = request_line.decode('ascii').split(' ', 2)
+                    url = urlsplit(target)
+                    body = await self._route(url.path, parse_qs(url.query))
+                    status = '200 OK'
+                except KeyError:
+                    body = {'error': 'not found or missing parameter'}
+                    status = '404 Not Found'
+                except ValueError:
+                    body = {'error': 'bad request'}
+                    status = '400 Bad Request'
+                self.latencies.add(time.perf_counter() - start)
+
+                payload = json.dumps(body).encode('utf-8')
+                writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    status, len(payload), '' if keep_alive else 'Connection: close\r\n'
+                ).encode('ascii') + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(server, host, port):
+    tcp_server = await asyncio.start_server(server.handle, host, port)
+    print('Serving on http://{}:{}'.format(host, port))
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('train_data_filename')
+    parser.add_argument('-k', '--neighbors', type=int, default=None,
+                        help='number of most similar users (items) to use (default: all)')
+    parser.add_argument('-m', '--mode', choices=('user', 'item'), default='user',
+                        help='user-based PCC or item-based adjusted cosine similarity (default: user)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of cached models (default: .recommender_cache next to the train file)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=64, help='max requests in a batch (default: 64)')
+    parser.add_argument('--max-delay', type=float, default=2,
+                        help='max milliseconds to wait for a batch to fill (default: 2)')
+    parser.add_argument('--lru-size', type=int, default=1024,
+                        help='number of users (items) to keep neighbor weights of (default: 1024)')
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(args.train_data_filename), '.recommender_cache')
+
+    recommender = Recommender(args.train_data_filename, None, args.neighbors, cache_dir, mode=args.mode)
+    recommender.build()
+
+    server = RecommendationServer(recommender, args.max_batch, args.max_delay / 1000, args.lru_size)
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        print('Served {} requests in {} batches, p50 {:.2f}ms, p99 {:.2f}ms'.format(
+            server.latencies.count,
+            server.batch_count,
+            server.latencies.percentile(50) * 1000,
+            server.latencies.percentile(99) * 1000
+        ))